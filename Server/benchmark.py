@@ -0,0 +1,421 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import websockets
+
+# Load generator and latency benchmark for the server.
+#
+# Simulates N gateways and M phones, each on its own websocket:
+#   - gateways send UpdateSpot at a fixed rate (open loop: latency is measured from when a
+#     request was due, so a slow server can't hide its backlog by slowing the senders down)
+#   - phones loop over a weighted mix of operations with a think time between them
+#
+# By default a throwaway server is started on free local ports against a throwaway mongod
+# (--mongod) in a temp directory, so no real data is touched. --db-uri uses an existing
+# (scratch!) Mongo instead, and --addr skips starting a server altogether. --workers runs the
+# local server as several worker processes, to compare throughput across worker counts.
+#
+# Prints one JSON document with throughput and p50/p95/p99 latency per operation, plus the
+# server's own per-operation stats, e.g.:
+#   python benchmark.py --gateways 10 --phones 200 --duration 60 --mix RefreshData=3,QuerySpot=5,Login=1
+
+#################################################### Constants
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+LOT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lots.json")
+DISCON_MSG = "!DISCONNECT"          # String to send to cleanly disconnect from the server
+
+DEFAULT_MIX = "RefreshData=4,QuerySpot=4,ReserveSpot=1,Login=1"
+PHONE_OPS = ["UpdateSpot", "RefreshData", "QuerySpot", "ReserveSpot", "Login"]
+PHONE_PASSWORD = "Bench-Pass1"      # Satisfies the server's password rules
+REQUEST_TIMEOUT = 10                # Seconds before a request counts as an error
+RESERVE_WAIT = 1                    # Seconds to wait for a ReserveSpot refusal; silence means the hold was granted
+STARTUP_TIMEOUT = 60                # Seconds to wait for mongod / the server to accept connections
+SETUP_CONCURRENCY = 8               # CreateAccount requests in flight while setting up phones
+
+####################################################
+
+RESULTS = {}                        # op -> {"latencies", "errors", "statuses", "held"}
+MEASURING = False                   # Set once the warmup is over
+
+def Record(op, latencyMs=None, status=None, error=False, held=False):
+    if not MEASURING:
+        return
+
+    result = RESULTS.setdefault(op, {"latencies": [], "errors": 0, "statuses": {}, "held": 0})
+    if error:
+        result["errors"] += 1
+    if held:
+        result["held"] += 1
+    if latencyMs is not None:
+        result["latencies"].append(latencyMs)
+    if status is not None:
+        result["statuses"][status] = result["statuses"].get(status, 0) + 1
+
+def Log(msg):
+    # stdout is reserved for the JSON report
+    print(msg, file=sys.stderr)
+
+#################################################### Connections
+
+# Requests carry a reqId and a reader task hands each reply to whoever is waiting on that
+# reqId, so one connection can have several requests outstanding.
+
+async def Connect(addr):
+    websocket = await websockets.connect(addr, max_size=None)
+    conn = {"websocket": websocket, "pending": {}, "nextId": 0}
+    conn["reader"] = asyncio.create_task(ReadReplies(conn))
+    return conn
+
+async def ReadReplies(conn):
+    try:
+        async for msg in conn["websocket"]:
+            reply = json.loads(msg)
+            future = conn["pending"].pop(reply.get("reqId"), None)
+            if future is not None and not future.done():
+                future.set_result(reply)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        for future in conn["pending"].values():
+            if not future.done():
+                future.set_exception(ConnectionError("connection closed"))
+        conn["pending"].clear()
+
+async def Close(conn):
+    try:
+        await conn["websocket"].send(DISCON_MSG)
+        await conn["websocket"].close()
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    conn["reader"].cancel()
+
+async def Request(conn, msg, timeout=REQUEST_TIMEOUT):
+    # Sends msg and returns its reply; raises asyncio.TimeoutError or ConnectionError
+    conn["nextId"] += 1
+    reqId = conn["nextId"]
+    future = asyncio.get_running_loop().create_future()
+    conn["pending"][reqId] = future
+
+    try:
+        await conn["websocket"].send(json.dumps({**msg, "reqId": reqId}))
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except websockets.exceptions.ConnectionClosed:
+        raise ConnectionError("connection closed")
+    except asyncio.TimeoutError:
+        conn["pending"].pop(reqId, None)
+        raise
+
+async def Timed(conn, op, msg, dueTime=None):
+    # Sends one request and records its latency (from dueTime, if given) and status
+    startTime = dueTime if dueTime is not None else time.perf_counter()
+
+    try:
+        reply = await Request(conn, msg, RESERVE_WAIT if op == "ReserveSpot" else REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        if op == "ReserveSpot": # Granted holds only get a reply when they end
+            Record(op, held=True)
+        else:
+            Record(op, error=True)
+        return None
+    except ConnectionError:
+        Record(op, error=True)
+        return None
+
+    if reply.get("status") == "rate_limited": # Turned away without doing the work, so no latency sample
+        Record(op, status="rate_limited")
+    else:
+        Record(op, (time.perf_counter() - startTime) * 1000, reply.get("status"))
+    return reply
+
+#################################################### Simulated clients
+
+async def Gateway(addr, spotIds, rate, stopTime):
+    conn = await Connect(addr)
+    requests = set()
+    interval = 1 / rate
+    dueTime = time.perf_counter()
+
+    try:
+        while dueTime < stopTime:
+            msg = {"op": "UpdateSpot", "id": random.choice(spotIds), "status": random.randint(0, 1)}
+            request = asyncio.create_task(Timed(conn, "UpdateSpot", msg, dueTime))
+            requests.add(request)
+            request.add_done_callback(requests.discard)
+
+            dueTime += interval
+            await asyncio.sleep(max(0, dueTime - time.perf_counter()))
+
+        if requests:
+            await asyncio.wait(requests)
+    finally:
+        await Close(conn)
+
+def PhoneMessage(op, name, spotIds):
+    spotId = random.choice(spotIds)
+    if op == "UpdateSpot":
+        return {"op": op, "id": spotId, "status": random.randint(0, 1)}
+    if op == "RefreshData":
+        return {"op": op}
+    if op == "QuerySpot":
+        return {"op": op, "id": spotId}
+    if op == "ReserveSpot":
+        return {"op": op, "id": spotId}
+    return {"op": "Login", "name": name, "passwd": PHONE_PASSWORD}
+
+async def Phone(addr, name, spotIds, ops, weights, think, stopTime):
+    conn = await Connect(addr)
+
+    try:
+        # Start out of step with the other phones
+        await asyncio.sleep(random.uniform(0, think))
+
+        while time.perf_counter() < stopTime:
+            op = random.choices(ops, weights)[0]
+            await Timed(conn, op, PhoneMessage(op, name, spotIds))
+            await asyncio.sleep(random.expovariate(1 / think) if think > 0 else 0)
+    finally:
+        await Close(conn)
+
+async def CreatePhoneAccount(addr, name):
+    # Each account gets its own connection, since the server rate-limits account operations
+    # per connection; a "rate_limited" reply is retried once retryAfter has passed
+    conn = await Connect(addr)
+    try:
+        while True:
+            reply = await Request(conn, {"op": "CreateAccount", "name": name, "passwd": PHONE_PASSWORD}, STARTUP_TIMEOUT)
+            if reply["status"] != "rate_limited":
+                return reply
+            await asyncio.sleep(reply["retryAfter"])
+    finally:
+        await Close(conn)
+
+async def CreatePhoneAccounts(addr, names):
+    # Accounts for the phones' Login requests; an existing account is fine
+    for first in range(0, len(names), SETUP_CONCURRENCY):
+        batch = names[first:first + SETUP_CONCURRENCY]
+        replies = await asyncio.gather(*(CreatePhoneAccount(addr, name) for name in batch))
+        for name, reply in zip(batch, replies):
+            if reply["status"] not in ("account_created", "name_used"):
+                Log(f"[SETUP] CreateAccount({name}) returned {reply['status']}")
+
+async def ServerStats(addr):
+    conn = await Connect(addr)
+    try:
+        return (await Request(conn, {"op": "Stats"}))["stats"]
+    finally:
+        await Close(conn)
+
+#################################################### Local server
+
+def FreePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def WaitForPort(port, process, what):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{what} exited during startup (code {process.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{what} didn't start listening on port {port} within {STARTUP_TIMEOUT}s")
+
+def StartLocalServer(args, workDir):
+    # Returns (websocket address, [processes]) for a server on free ports, plus a mongod if needed
+    processes = []
+    dbUri = args.db_uri
+
+    if dbUri is None:
+        mongodPort = FreePort()
+        dbPath = os.path.join(workDir, "db")
+        os.makedirs(dbPath)
+        mongodLog = open(os.path.join(workDir, "mongod.log"), "w")
+        Log(f"[SETUP] Starting mongod on port {mongodPort} (data in {dbPath})...")
+        mongod = subprocess.Popen(
+            [args.mongod, "--dbpath", dbPath, "--port", str(mongodPort), "--bind_ip", "127.0.0.1"],
+            stdout=mongodLog, stderr=subprocess.STDOUT
+        )
+        processes.append(mongod)
+        WaitForPort(mongodPort, mongod, "mongod")
+        dbUri = f"mongodb://127.0.0.1:{mongodPort}"
+
+    serverPort = FreePort()
+    env = dict(
+        os.environ,
+        SPOTME_PORT=str(serverPort),
+        SPOTME_METRICS_PORT=str(FreePort()),
+        SPOTME_INGEST_PORT=str(FreePort()),
+        SPOTME_DB_URI=dbUri,
+        SPOTME_WORKERS=str(args.workers),
+        SPOTME_BROKER_PATH=os.path.join(workDir, "broker.sock")
+    )
+    serverLog = open(os.path.join(workDir, "server.log"), "w")
+    Log(f"[SETUP] Starting server on port {serverPort} (log in {serverLog.name})...")
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT], env=env, stdout=serverLog, stderr=subprocess.STDOUT)
+    processes.append(server)
+    WaitForPort(serverPort, server, "server")
+
+    return f"ws://127.0.0.1:{serverPort}", processes
+
+def StopProcesses(processes):
+    # Server first (SIGINT lets it flush), then mongod
+    for process in reversed(processes):
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+#################################################### Report
+
+def Percentile(sortedSamples, fraction):
+    if not sortedSamples:
+        return None
+    return round(sortedSamples[min(len(sortedSamples) - 1, int(fraction * len(sortedSamples)))], 3)
+
+def Report(config, elapsed, serverStats):
+    ops = {}
+    for op, result in sorted(RESULTS.items()):
+        latencies = sorted(result["latencies"])
+        ops[op] = {
+            "completed": len(latencies),
+            "errors": result["errors"],
+            "held": result["held"],
+            "throughput_per_s": round((len(latencies) + result["held"]) / elapsed, 2),
+            "latency_ms": {
+                "p50": Percentile(latencies, 0.50),
+                "p95": Percentile(latencies, 0.95),
+                "p99": Percentile(latencies, 0.99),
+                "max": round(latencies[-1], 3) if latencies else None,
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else None
+            },
+            "statuses": result["statuses"]
+        }
+
+    completed = sum(op["completed"] + op["held"] for op in ops.values())
+    return {
+        "config": config,
+        "elapsed_s": round(elapsed, 3),
+        "total": {
+            "completed": completed,
+            "errors": sum(op["errors"] for op in ops.values()),
+            "throughput_per_s": round(completed / elapsed, 2)
+        },
+        "ops": ops,
+        "server": serverStats
+    }
+
+#################################################### Startup
+
+def ParseMix(text):
+    ops, weights = [], []
+    for entry in text.split(","):
+        op, _, weight = entry.partition("=")
+        if op not in PHONE_OPS:
+            raise argparse.ArgumentTypeError(f"unknown op '{op}' (expected one of {', '.join(PHONE_OPS)})")
+        ops.append(op)
+        weights.append(float(weight or 1))
+    return ops, weights
+
+def LoadSpotIds(path=LOT_CONFIG):
+    with open(path) as configFile:
+        config = json.load(configFile)
+    with open(os.path.join(os.path.dirname(path), config["layout"])) as layoutFile:
+        layout = json.load(layoutFile)
+    return layout["id"] if isinstance(layout, dict) else [spot["id"] for spot in layout]
+
+async def Run(args, addr):
+    global MEASURING
+    ops, weights = args.mix
+    spotIds = LoadSpotIds()
+    names = [f"bench-phone-{index}" for index in range(args.phones)]
+
+    if "Login" in ops:
+        Log(f"[SETUP] Creating {len(names)} phone accounts...")
+        await CreatePhoneAccounts(addr, names)
+
+    Log(f"[RUN] {args.gateways} gateways at {args.gateway_rate}/s, {args.phones} phones, {args.warmup}s warmup + {args.duration}s...")
+    startTime = time.perf_counter()
+    stopTime = startTime + args.warmup + args.duration
+    clients = [Gateway(addr, spotIds, args.gateway_rate, stopTime) for _ in range(args.gateways)]
+    clients += [Phone(addr, name, spotIds, ops, weights, args.think, stopTime) for name in names]
+    clientTasks = asyncio.gather(*clients)
+
+    await asyncio.sleep(args.warmup)
+    MEASURING = True
+    measureStart = time.perf_counter()
+    await clientTasks
+    elapsed = min(time.perf_counter(), stopTime) - measureStart
+    MEASURING = False
+
+    limited = {op: result["statuses"]["rate_limited"] for op, result in RESULTS.items() if "rate_limited" in result["statuses"]}
+    if limited:
+        Log(f"[WARN] The server rate-limited {limited} requests (see RATE_LIMITS in server.py); they're left out of latency and throughput.")
+
+    return elapsed, await ServerStats(addr)
+
+def Main():
+    parser = argparse.ArgumentParser(description="Drive simulated gateways and phones against the server and report latency.")
+    parser.add_argument("--addr", help="benchmark a running server at this ws:// address instead of starting one")
+    parser.add_argument("--db-uri", help="Mongo for the local server to use instead of a throwaway mongod (it will write to it!)")
+    parser.add_argument("--mongod", default=shutil.which("mongod") or "mongod", help="mongod binary for the throwaway DB")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the local server (default: %(default)s)")
+    parser.add_argument("--gateways", type=int, default=4, help="simulated gateways (default: %(default)s)")
+    parser.add_argument("--gateway-rate", type=float, default=10, help="UpdateSpot requests per second per gateway (default: %(default)s)")
+    parser.add_argument("--phones", type=int, default=50, help="simulated phones (default: %(default)s)")
+    parser.add_argument("--mix", type=ParseMix, default=DEFAULT_MIX, help="phone op weights (default: %(default)s)")
+    parser.add_argument("--think", type=float, default=1, help="mean seconds a phone waits between ops (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds (default: %(default)s)")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds before measuring starts (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="random seed, for repeatable runs")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "mix")}
+    config["mix"] = dict(zip(*args.mix))
+
+    processes = []
+    workDir = tempfile.mkdtemp(prefix="spotme-bench-")
+    try:
+        addr = args.addr
+        if addr is None:
+            addr, processes = StartLocalServer(args, workDir)
+
+        elapsed, serverStats = asyncio.run(Run(args, addr))
+    except BaseException:
+        Log(f"[ERROR] Benchmark failed; server and mongod logs are in {workDir}")
+        raise
+    finally:
+        StopProcesses(processes)
+
+    shutil.rmtree(workDir, ignore_errors=True)
+
+    report = json.dumps(Report(config, elapsed, serverStats), indent=2)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(report + "\n")
+        Log(f"[DONE] Report written to {args.output}")
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    Main()
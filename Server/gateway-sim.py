@@ -1,50 +1,40 @@
 import asyncio
-import json
 import random
+import struct
 import websockets
 
 #################################################### Constants
 
-ADDR = 'ws://34.169.42.70:15024'   # Public address + port of server machine
-DISCON_MSG = "!DISCONNECT"          # String to send to cleanly disconnect from the server
+ADDR = 'ws://34.169.42.70:15026'   # Public address + gateway ingestion port of server machine
 
 MAX_SPOTS = 1251                     # ONLY FOR P6; P5 will be manually updated to test pin colors
+READINGS_PER_FRAME = 20              # Sensor readings batched into each frame
 
 # vvv For local testing only (comment out when running on server)
-# ADDR = 'ws://localhost:15024'
+# ADDR = 'ws://localhost:15026'
 
 ####################################################
 
-async def Send(websocket, msg):
-    await websocket.send(msg)
-    response = await websocket.recv()
-    return response
+def EncodeFrame(readings):
+    # One little-endian uint32 per reading: (space_id << 2) | status
+    return struct.pack(f"<{len(readings)}I", *((spotID << 2) | status for spotID, status in readings))
 
 async def Start():
     async with websockets.connect(ADDR) as websocket:
 
         # Summary of operation:
-        #   - Pick a random spot from the list of spots by ID.
-        #   - Initialize a "ParkingSpot" dictionary object initialized with this ID
-        #     and a random state to change it to (0 = free, 1 = occupied, 2 = reserved)
-        #   - Stringify this dictionary into a JSON string.
-        #   - Send this JSON string to the server.
+        #   - Pick random spots from the list of spots by ID.
+        #   - Give each a random reading (0 = free, 1 = occupied); sensors can't see reservations.
+        #   - Pack the readings into one binary frame and send it to the ingestion port.
+        #     The server doesn't reply; it debounces the readings and applies them in batches.
         #   - Repeat every second.
 
         while True:
-            spotID = random.randint(1, MAX_SPOTS)
-
-            updSpotInfo = {
-                "op": "UpdateSpot",
-                "id": spotID,
-                "status": random.randint(0,2),
-            }
-            
-            msg = json.dumps(updSpotInfo)
-            print(f"[OUTBOUND] {msg}")
-            response = await Send(websocket, msg)
-            print(f"[RECEIVED] {response}")
+            readings = [(random.randint(1, MAX_SPOTS), random.randint(0, 1)) for _ in range(READINGS_PER_FRAME)]
+
+            print(f"[OUTBOUND] {readings}")
+            await websocket.send(EncodeFrame(readings))
 
             await asyncio.sleep(1)
 
-asyncio.run(Start())
\ No newline at end of file
+asyncio.run(Start())
@@ -1,241 +1,182 @@
+import argparse
 import json
-
-def generate_parking_data(start_lat, start_lon, blocks, spots_per_row):
-    # Define constants for offsets
-    spot_width = 0.0000311       # Longitude offset for one spot (9 feet)
-    row_height = 0.0000622       # Latitude offset for one row (18 feet)
-    block_separation = 0.00004495 # Latitude separation between blocks (~13 feet)
-
-    parking_data = []
-    spot_id = 1
-
-    # Vertical blocks facing east (4th block, handicap)            
-    extra1_start_lat = 36.814207
-    extra1_start_lon = -119.74260
-    final_spots_per_row = 5
-    block = 1
-    parkingLotID = "P6"
-    
-    extra_spots_width = 0.0000227 # latitude offset
-    extra_spots_height = 0.0000622 # longitude offset
-    for spot in range(final_spots_per_row):
-        # Compute the spot's coordinates
-            lower_left = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon}
-            lower_right = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_right = {"latitude": extra1_start_lat  -((spot + 1) * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_left = {"latitude": extra1_start_lat - ((spot + 1) * extra_spots_width), "longitude": extra1_start_lon}
-
-            # Add spot data
-            parking_data.append({
-                "parkingLot": parkingLotID,
-                # "marker" : getCoordinatesMarker(parkingLotID),
-                "block": block,
-                "id": spot_id,
-                "coordinates": [lower_left, lower_right, upper_right, upper_left, lower_left],
-                })
-
-            spot_id += 1
-    
-    # Horizontal blocks facing norht (Northmost)            
-    extra1_start_lat = 36.814255
-    extra1_start_lon = -119.742505
-    final_spots_per_row = 17
-    parkingLotID = "P6"
-    block += 1
-
-    for spot in range(final_spots_per_row):
-            # Compute the spot's coordinates
-            lower_left = {"latitude": extra1_start_lat, "longitude": extra1_start_lon + (spot * spot_width)}
-            lower_right = {"latitude": extra1_start_lat, "longitude": extra1_start_lon + ((spot + 1) * spot_width)}
-            upper_right = {"latitude": extra1_start_lat + row_height, "longitude": extra1_start_lon + ((spot + 1) * spot_width)}
-            upper_left = {"latitude": extra1_start_lat + row_height, "longitude": extra1_start_lon + (spot * spot_width)}
-
-            # Add spot data
-            parking_data.append({
-                "parkingLot": parkingLotID,
-                # "marker" : getCoordinatesMarker(parkingLotID),
-                "block": block,
-                "id": spot_id,
-                "coordinates": [lower_left, lower_right, upper_right, upper_left, lower_left],
-            })
-
-            spot_id += 1
-
-    # Vertical blocks facing east (1st block)            
-    extra1_start_lat = 36.8142663
-    extra1_start_lon = -119.7409249
-    final_spots_per_row = 32
-    parkingLotID = "P6"
-    block += 1
-    
-    extra_spots_width = 0.0000247 # latitude offset
-    extra_spots_height = 0.0000622 # longitude offset
-    for spot in range(final_spots_per_row):
-        # Compute the spot's coordinates
-            lower_left = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon}
-            lower_right = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_right = {"latitude": extra1_start_lat  -((spot + 1) * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_left = {"latitude": extra1_start_lat - ((spot + 1) * extra_spots_width), "longitude": extra1_start_lon}
-
-            # Add spot data
-            parking_data.append({
-                "parkingLot": parkingLotID,
-                #"marker" : getCoordinatesMarker(parkingLotID),
-                "block": block,
-                "id": spot_id,
-                "coordinates": [lower_left, lower_right, upper_right, upper_left, lower_left],
-                })
-
-            spot_id += 1
-
-    # Vertical blocks facing east (2nd block)            
-    extra1_start_lat = 36.8132664
-    extra1_start_lon = -119.7409249
-    final_spots_per_row = 45
-    parkingLotID = "P6"
-    block += 1
-    
-    extra_spots_width = 0.0000227 # latitude offset
-    extra_spots_height = 0.0000622 # longitude offset
-    for spot in range(final_spots_per_row):
-        # Compute the spot's coordinates
-            lower_left = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon}
-            lower_right = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_right = {"latitude": extra1_start_lat  -((spot + 1) * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_left = {"latitude": extra1_start_lat - ((spot + 1) * extra_spots_width), "longitude": extra1_start_lon}
-
-            # Add spot data
-            parking_data.append({
-                "parkingLot": parkingLotID,
-                #"marker" : getCoordinatesMarker(parkingLotID),
-                "block": block,
-                "id": spot_id,
-                "coordinates": [lower_left, lower_right, upper_right, upper_left, lower_left],
-                })
-
-            spot_id += 1
-
-    # Horizontal spots facing north
-    for block in range(blocks):
-        # Determine the number of rows and spots per block based on the block index (According to Fresno State map && Google Earth)
-        if block < 11: 
-            parkingLotID = "P6"
-            rows_per_block = 2
-            block_start_lat = start_lat - (block * (rows_per_block * row_height + block_separation))
-        elif block in [11, 12, 19]: # This blocks have 1 row only
-            rows_per_block = 1
-            if block == 11 or block == 12:
-                parkingLotID = "P6"
-                block_start_lat = start_lat - (block * (2* rows_per_block * row_height + block_separation)) +row_height
-            else:
-                parkingLotID = "P5"
-                block_start_lat = start_lat - (block * (2* rows_per_block * row_height + block_separation))+2*row_height
-
-        else: # Regular blocks have 2 rows
-            parkingLotID = "P5"
-            rows_per_block = 2
-            block_start_lat = start_lat - (block * (rows_per_block * row_height + block_separation)) + row_height
-            if block == 16:
-                spots_per_row = 47
-                start_lon = start_lon + ((48-47)*spot_width)
-            elif block == 17:
-                spots_per_row = 43
-                start_lon = start_lon + ((47-43)*spot_width)
-            elif block == 18:
-                spots_per_row = 39
-                start_lon = start_lon + ((43-39)*spot_width)
-            elif block == 19:
-                spots_per_row = 38
-                start_lon = start_lon + ((40-38)*spot_width)
-
-        for row in range(rows_per_block):
-            # Compute the row's starting lower-left corner
-            row_start_lat = block_start_lat + (row * row_height)
-            if (block in [16, 17]) and row == 0: # This blocks have a deleted spot on the lower left corner
-                final_spots_per_row = spots_per_row - 1 # Reduce number of spots by 1 due to shifting
-                adj_lon = start_lon + spot_width  # Shift spots to the left
-            else:
-                adj_lon = start_lon
-                final_spots_per_row = spots_per_row
-
-            for spot in range(final_spots_per_row):
-                # Compute the spot's coordinates
-                lower_left = {"latitude": row_start_lat, "longitude": adj_lon + (spot * spot_width)}
-                lower_right = {"latitude": row_start_lat, "longitude": adj_lon + ((spot + 1) * spot_width)}
-                upper_right = {"latitude": row_start_lat + row_height, "longitude": adj_lon + ((spot + 1) * spot_width)}
-                upper_left = {"latitude": row_start_lat + row_height, "longitude": adj_lon + (spot * spot_width)}
-
-                # Add spot data
-                parking_data.append({
-                    "parkingLot": parkingLotID,
-                    #"marker" : getCoordinatesMarker(parkingLotID),
-                    "block": block,
-                    "id": spot_id,
-                    "coordinates": [lower_left, lower_right, upper_right, upper_left, lower_left],
-                })
-
-                spot_id += 1
-
-    # Vertical blocks facing east (3rd block)  
-    parkingLotID = "P5"          
-    extra1_start_lat = 36.8119623
-    extra1_start_lon = -119.74093
-    final_spots_per_row = 39
-    block += 1
-    
-    extra_spots_width = 0.0000227 # latitude offset
-    extra_spots_height = 0.0000622 # longitude offset
-    for spot in range(final_spots_per_row):
-        # Compute the spot's coordinates
-            lower_left = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon}
-            lower_right = {"latitude": extra1_start_lat - (spot * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_right = {"latitude": extra1_start_lat  -((spot + 1) * extra_spots_width), "longitude": extra1_start_lon + extra_spots_height}
-            upper_left = {"latitude": extra1_start_lat - ((spot + 1) * extra_spots_width), "longitude": extra1_start_lon}
-
-            # Add spot data
-            parking_data.append({
-                "parkingLot": parkingLotID,
-                # "marker" : getCoordinatesMarker(parkingLotID),
-                "block": block,
-                "id": spot_id,
-                "coordinates": [lower_left, lower_right, upper_right, upper_left, lower_left],
-                })
-
-            spot_id += 1
-
-    return parking_data
-
-
-# Example usage
-starting_latitude = 36.81409
-starting_longitude = -119.74248
-number_of_blocks = 20
-default_spots_per_row = 48
-#extra_blocks = 1
-
-def getCoordinatesMarker(lot_name):
-    # Define the coordinates for each parking lot
-    if lot_name == "P6":
-        # Coordinates format: (latitude, longitude)
-        return [(36.813302, -119.741799)]
-    elif lot_name == "P5":
-        return [(36.811609, -119.741742
-)]
-    else:
-        return "Parking lot not found"
-
-
-parking_lot_data = generate_parking_data(
-    start_lat=starting_latitude,
-    start_lon=starting_longitude,
-    blocks=number_of_blocks,
-    spots_per_row=default_spots_per_row,
-    #extra = extra_blocks,
-)
-
-json_string = json.dumps(parking_lot_data)
-# Save to JSON file
-with open("C:\\Users\\lmcal\\Desktop\\Spot-Me\\application\\assets\\parking_lot_data.json", "w") as json_file:
-    json.dump(parking_lot_data, json_file, indent=4)
-
-print("Parking lot data generated and saved to parking_lot_data.json")
+import os
+import struct
+import numpy as np
+
+# Builds every parking spot's polygon from a lot-layout spec (lot-layout.json) and writes:
+#   - the compact columnar layout: id/lot/block columns plus each spot's four corners as
+#     float32 offsets from one float64 origin (the app and server load this one)
+#   - optionally the same columns as a binary file
+#   - the legacy list of spots with five {"latitude", "longitude"} corners each
+#
+# A spec has default "spot_width" (along a row) and "spot_depth" (across it) in degrees, and a
+# list of "blocks", each with:
+#   "lot", "block"      - parking lot and block number of its spots
+#   "facing"            - "north": rows run east from the origin and stack north
+#                         "east": rows run south from the origin and stack east
+#   "origin"            - [latitude, longitude] of the first row's first corner
+#   "rows"              - rows in the block (default 1)
+#   "spots"             - spots per row, or a list with one count per row
+#   "offsets"           - spots each row starts past the origin (default 0 for every row)
+#   "spot_width", "spot_depth" - override the spec's defaults for this block
+# Spots are numbered from 1 in spec order, row by row. Adding a lot only takes new blocks.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSETS_DIR = os.path.join(SCRIPT_DIR, "..", "application", "assets")
+
+DEFAULT_SPEC = os.path.join(SCRIPT_DIR, "lot-layout.json")
+DEFAULT_COLUMNS = os.path.join(ASSETS_DIR, "parking_lot_columns.json")
+DEFAULT_LEGACY = os.path.join(ASSETS_DIR, "parking_lot_data.json")
+
+COLUMNS_FORMAT = "spot-columns"
+COLUMNS_VERSION = 1
+BINARY_MAGIC = b"SPOTCOL1"      # Binary layout: magic, uint32 header length, JSON header, then
+                                # id <u4[n], lot <u2[n], block <u2[n], corners <f4[n, 4, 2]
+
+def expand_rows(spec):
+    # Flattens the spec's blocks into one entry per row, as parallel arrays
+    lots = []
+    rows = {key: [] for key in ("lot", "block", "east", "lat", "lon", "row", "width", "depth", "count", "offset")}
+
+    for block in spec["blocks"]:
+        if block["lot"] not in lots:
+            lots.append(block["lot"])
+
+        rowCount = block.get("rows", 1)
+        spots = block["spots"] if isinstance(block["spots"], list) else [block["spots"]] * rowCount
+        offsets = block.get("offsets", [0] * rowCount)
+        if len(spots) != rowCount or len(offsets) != rowCount:
+            raise ValueError(f'Block {block["lot"]}/{block["block"]}: "spots" and "offsets" need one entry per row')
+
+        for row in range(rowCount):
+            rows["lot"].append(lots.index(block["lot"]))
+            rows["block"].append(block["block"])
+            rows["east"].append(block["facing"] == "east")
+            rows["lat"].append(block["origin"][0])
+            rows["lon"].append(block["origin"][1])
+            rows["row"].append(row)
+            rows["width"].append(block.get("spot_width", spec["spot_width"]))
+            rows["depth"].append(block.get("spot_depth", spec["spot_depth"]))
+            rows["count"].append(spots[row])
+            rows["offset"].append(offsets[row])
+
+    return lots, {key: np.array(values) for key, values in rows.items()}
+
+def generate_parking_data(spec):
+    # Returns (lots, ids, lot indices, blocks, latitudes, longitudes); the last two are
+    # (spots, 4) arrays of the lower left, lower right, upper right and upper left corners
+    lots, rows = expand_rows(spec)
+    east = rows["east"]
+
+    # Where each row starts: rows stack north (or east) by one spot depth, then skip "offset" spots
+    rowLat = np.where(east, rows["lat"], rows["lat"] + rows["row"] * rows["depth"])
+    rowLon = np.where(east, rows["lon"] + rows["row"] * rows["depth"], rows["lon"])
+    rowLat = np.where(east, rowLat - rows["offset"] * rows["width"], rowLat)
+    rowLon = np.where(east, rowLon, rowLon + rows["offset"] * rows["width"])
+
+    # One entry per spot: its row, and its position along that row
+    counts = rows["count"]
+    rowOf = np.repeat(np.arange(len(counts)), counts)
+    position = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)).astype(np.float64)
+
+    spotEast = east[rowOf]
+    width = rows["width"][rowOf]
+    depth = rows["depth"][rowOf]
+    lat = rowLat[rowOf]
+    lon = rowLon[rowOf]
+
+    # Corners along the row (a0 -> a1) and across it (b0 -> b1)
+    a0 = np.where(spotEast, lat - position * width, lon + position * width)
+    a1 = np.where(spotEast, lat - (position + 1) * width, lon + (position + 1) * width)
+    b0 = np.where(spotEast, lon, lat)
+    b1 = np.where(spotEast, lon + depth, lat + depth)
+
+    # North-facing: LL (b0, a0), LR (b0, a1), UR (b1, a1), UL (b1, a0) as (lat, lon)
+    # East-facing:  LL (a0, b0), LR (a0, b1), UR (a1, b1), UL (a1, b0)
+    alongCorners = np.stack([a0, a1, a1, a0], axis=1)
+    eastAcross = np.stack([b0, b1, b1, b0], axis=1)
+    northAcross = np.stack([b0, b0, b1, b1], axis=1)
+    eastAlong = np.stack([a0, a0, a1, a1], axis=1)
+
+    latitudes = np.where(spotEast[:, None], eastAlong, northAcross)
+    longitudes = np.where(spotEast[:, None], eastAcross, alongCorners)
+
+    ids = np.arange(1, len(rowOf) + 1)
+    return lots, ids, rows["lot"][rowOf], rows["block"][rowOf], latitudes, longitudes
+
+def to_columns(lots, ids, lotIndices, blocks, latitudes, longitudes):
+    # Compact columnar layout; corners are float32 offsets from a rounded float64 origin,
+    # which keeps them well under a millimeter from the float64 coordinates
+    origin = [round(float(latitudes.mean()), 6), round(float(longitudes.mean()), 6)]
+    corners = np.stack([latitudes - origin[0], longitudes - origin[1]], axis=2).astype(np.float32)
+
+    return {
+        "format": COLUMNS_FORMAT,
+        "version": COLUMNS_VERSION,
+        "lots": lots,
+        "origin": origin,
+        "id": ids.tolist(),
+        "lot": lotIndices.tolist(),
+        "block": blocks.tolist(),
+        # Shortest text that reads back as the same float32
+        "corners": [float(str(value)) for value in corners.ravel()]
+    }
+
+def write_binary(path, columns):
+    header = {key: columns[key] for key in ("format", "version", "lots", "origin")}
+    header["count"] = len(columns["id"])
+    header = json.dumps(header).encode()
+
+    with open(path, "wb") as binaryFile:
+        binaryFile.write(BINARY_MAGIC)
+        binaryFile.write(struct.pack("<I", len(header)))
+        binaryFile.write(header)
+        binaryFile.write(np.array(columns["id"], dtype="<u4").tobytes())
+        binaryFile.write(np.array(columns["lot"], dtype="<u2").tobytes())
+        binaryFile.write(np.array(columns["block"], dtype="<u2").tobytes())
+        binaryFile.write(np.array(columns["corners"], dtype="<f4").tobytes())
+
+def to_legacy(lots, ids, lotIndices, blocks, latitudes, longitudes):
+    # The original list of spots, each polygon closed by repeating its first corner
+    legacy = []
+    for id, lotIndex, block, spotLats, spotLons in zip(ids.tolist(), lotIndices.tolist(), blocks.tolist(), latitudes.tolist(), longitudes.tolist()):
+        corners = [{"latitude": lat, "longitude": lon} for lat, lon in zip(spotLats, spotLons)]
+        legacy.append({
+            "parkingLot": lots[lotIndex],
+            "block": block,
+            "id": id,
+            "coordinates": corners + [corners[0]]
+        })
+    return legacy
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate parking spot geometry from a lot-layout spec.")
+    parser.add_argument("--spec", default=DEFAULT_SPEC, help="lot-layout spec to read (default: %(default)s)")
+    parser.add_argument("--columns", default=DEFAULT_COLUMNS, help="compact columnar JSON to write (default: %(default)s)")
+    parser.add_argument("--binary", help="also write the columns in binary form to this path")
+    parser.add_argument("--legacy", default=DEFAULT_LEGACY, help="legacy spot list JSON to write (default: %(default)s)")
+    parser.add_argument("--no-legacy", action="store_true", help="skip the legacy spot list")
+    args = parser.parse_args()
+
+    with open(args.spec) as specFile:
+        spec = json.load(specFile)
+
+    layout = generate_parking_data(spec)
+    columns = to_columns(*layout)
+
+    with open(args.columns, "w") as columnsFile:
+        json.dump(columns, columnsFile, separators=(",", ":"))
+    print(f"Wrote {len(columns['id'])} spots to {args.columns}")
+
+    if args.binary:
+        write_binary(args.binary, columns)
+        print(f"Wrote {len(columns['id'])} spots to {args.binary}")
+
+    if not args.no_legacy:
+        with open(args.legacy, "w") as legacyFile:
+            json.dump(to_legacy(*layout), legacyFile, indent=4)
+        print(f"Wrote {len(columns['id'])} spots to {args.legacy}")
+
+if __name__ == "__main__":
+    main()
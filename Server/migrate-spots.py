@@ -0,0 +1,31 @@
+import argparse
+import asyncio
+import server
+
+# Moves the spots in the DB between the two storage layouts (see STORAGE_MODE in server.py):
+#   python migrate-spots.py                 one document per spot (the default layout)
+#   python migrate-spots.py --to lots       back into each lot document's "spaces" array
+# Stop the server first; it writes spots in its own layout. The server also migrates to its
+# configured layout at startup, so this is only needed to migrate ahead of time or roll back.
+
+async def Migrate(mode):
+    await server.EnsureIndexes()
+    migrated = await server.MigrateSpotStorage(mode)
+
+    if migrated:
+        print(f"[MIGRATE] Moved {migrated} lots to '{mode}' storage.")
+    else:
+        print(f"[MIGRATE] Everything is already in '{mode}' storage, doing nothing.")
+
+def Main():
+    parser = argparse.ArgumentParser(description="Move spot storage between one document per spot and per-lot spaces arrays.")
+    parser.add_argument("--to", choices=["spots", "lots"], default="spots", help="storage layout to move to (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.to != server.STORAGE_MODE:
+        print(f"[MIGRATE] Note: the server is configured for '{server.STORAGE_MODE}' storage (SPOTME_STORAGE) and will move the spots back when it starts.")
+
+    asyncio.run(Migrate(args.to))
+
+if __name__ == "__main__":
+    Main()
@@ -2,115 +2,1227 @@ import asyncio
 import bcrypt
 import json
 import pymongo
-from datetime import datetime
+import numpy as np
+from datetime import datetime, date, timedelta
 import websockets
 import re
+import os
+import sys
+import math
+import struct
+import time
+import base64
+import hmac
+import hashlib
+import secrets
+import functools
+import heapq
+import bisect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from array import array
+from collections import deque
 
 #################################################### Constants
 
-PORT = 15024
+# The ports and DB_URI can be overridden from the environment (benchmark.py runs a throwaway
+# server this way)
+PORT = int(os.environ.get("SPOTME_PORT", 15024))
+METRICS_PORT = int(os.environ.get("SPOTME_METRICS_PORT", 15025)) # Plain-text operation metrics over HTTP
+INGEST_PORT = int(os.environ.get("SPOTME_INGEST_PORT", 15026))   # Batched sensor frames from gateways
+WORKER_METRICS_PORT = int(os.environ.get("SPOTME_WORKER_METRICS_PORT", 15100)) # With several workers, worker n's metrics are on this + n
 DISCONNECT_MESSAGE = "!DISCONNECT"
 
-DB_CLIENT = pymongo.MongoClient('localhost', 27017)
+DB_POOL_SIZE = 16                   # Max concurrent DB operations (and pooled DB connections)
+
+DB_URI = os.environ.get("SPOTME_DB_URI", "mongodb://localhost:27017")
+DB_CLIENT = pymongo.MongoClient(DB_URI, maxPoolSize=DB_POOL_SIZE)
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+WORKERS = int(os.environ.get("SPOTME_WORKERS", 1)) # Server processes sharing the ports (see Workers and state broker)
+WORKER_ID = int(os.environ.get("SPOTME_WORKER_ID", 0)) # This process's number; set by the supervisor
+IS_WORKER = "SPOTME_WORKER_ID" in os.environ # Started by a supervisor, which has already prepared the DB
+IS_LEADER = WORKER_ID == 0          # The worker that expires reservations and writes spot state to the DB
+BROKER = os.environ.get("SPOTME_BROKER", "socket" if WORKERS > 1 else "local") # Name in BROKERS
+BROKER_PATH = os.environ.get("SPOTME_BROKER_PATH", f"/tmp/spotme-broker-{PORT}.sock") # Unix socket of the "socket" broker
+BROKER_LINE_LIMIT = 2 ** 24         # Longest command (in bytes) the socket broker relays
+
+BCRYPT_ROUNDS = 12                  # bcrypt cost factor for new password hashes
+AUTH_WORKERS = max(1, (os.cpu_count() or 1) // WORKERS) # Processes doing password hashing/checking, per worker
+AUTH_QUEUE_LIMIT = 64               # Max hash/check jobs in flight before auth requests are turned away
+
+SESSION_TTL = 12 * 60 * 60          # Seconds a Login session token stays valid
+SESSION_SECRET = secrets.token_bytes(32) # Signs session tokens; tokens don't survive a restart
+STORAGE_MODE = os.environ.get("SPOTME_STORAGE", "spots") # "spots": a document per spot, "lots": spots embedded in their lot
 DB = DB_CLIENT['spotme']
 USERS_COL = DB['users']
 SPOTS_COL = DB['lots']
+SPOT_DOCS_COL = DB['spots']         # One document per spot when STORAGE_MODE is "spots"
+RESV_COL = DB['reservations']
+HIST_COL = DB['congestion_history']
+
+GRID_CELL_SIZE = 25                 # Meters per side of a spatial index cell
+MAX_NEAREST = 50                    # Most spots one FindNearestFree call may ask for
+PERMITS = ["green", "yellow", "black", "gold", "handicap"] # Permit classes, in the order of a user's "permits" flags
+LOT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lots.json") # Registered lots and their layout
+
+FLUSH_INTERVAL = 1                  # Seconds between write-behind flushes of spot changes to the DB
+CHANGE_LOG_SIZE = 10000             # Recent spot changes kept for Snapshot diffs
+MAX_DIFF_SPOTS = 500                # Diffs bigger than this are sent as a full snapshot instead
+REFRESH_COALESCE = 0.25             # Seconds a cached RefreshData reply may trail behind spot changes
+MAX_OPS_PER_CONNECTION = 16         # Operations one connection may have in progress at once
+MAX_CONNECTIONS = 2000              # Phone connections one server process takes; more are closed with "server_full"
+MAX_GATEWAY_CONNECTIONS = 200       # Gateway connections on INGEST_PORT, likewise
+SEND_QUEUE_LIMIT = 64               # Outgoing messages one connection may have waiting to be sent
+SEND_PUSH_LIMIT = 48                # Of those, the most that may be pushes, so replies always have room
+SEND_POLICIES = {                   # What happens to a message that finds its connection's queue full:
+    "reply": "close",               #   replies can't go missing, so the connection is closed ("slow_consumer")
+    "push": "drop"                  #   SpotDeltas are dropped, and the client is told to resync once caught up
+}
+RATE_LIMITS = {                     # Op class -> (operations per second, burst), per connection
+    "auth": (0.5, 5),               #   bcrypt checks and account changes
+    "refresh": (1, 5),              #   RefreshData, the biggest reply
+    "read": (20, 40),               #   cheap reads: QuerySpot, Snapshot, FindNearestFree, ...
+    "update": (50, 100),            #   UpdateSpot(s) from gateways still on the phone port
+    "reserve": (1, 5)               #   ReserveSpot
+}
+INGEST_DEBOUNCE = 2                 # Seconds a sensor's new reading must hold before it's applied
+INGEST_BATCH_INTERVAL = 0.25        # Seconds between batches of debounced sensor readings
+INGEST_MAX_FRAME = 4096             # Most readings one gateway frame may carry
+LATENCY_SAMPLES = 1024              # Recent latencies kept per operation for percentiles
+HIST_WINDOWS = {                    # Named averaging windows for congestion history, in days
+    "4weeks": 4 * 7,
+    "semester": 16 * 7,
+    "year": 365
+}
+CONG_AVG_WINDOW = "4weeks"          # Window used for the avgCong sent to clients
+HIST_GRACE = 5 * 60                 # Seconds a history sample may run late before its slot counts as missed
+FORECAST_SLOTS = 8                  # Upcoming half-hour slots forecast per lot
+FORECAST_INTERVAL = 60              # Seconds between forecast refreshes (plus one at every slot)
+FORECAST_DECAY = 0.7                # Per-slot decay of today's deviation from the historical average
+HIST_BACKFILL_LIMIT = 2             # Missed slots (after downtime) filled with the last known congestion
+RESERVATION_TIME = 15               # Seconds a ReserveSpot hold lasts before the spot is freed again
+
+#################################################### Database access
+
+# pymongo is blocking, so every DB call goes through RunDB(), which runs it on a bounded
+# thread pool. This way a slow query only holds up the client that asked for it instead of
+# stalling the whole event loop.
+
+async def RunDB(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+async def FindAll(col, *args, **kwargs):
+    # Like col.find(), but the cursor is drained on the DB pool too
+    return await RunDB(lambda: list(col.find(*args, **kwargs)))
+
+#################################################### Password hashing
+
+# bcrypt is deliberately slow, so hashing and checking passwords runs on a process pool
+# instead of the event loop. At most AUTH_QUEUE_LIMIT jobs are in flight; past that, auth
+# requests get "server_busy" straight away rather than piling up behind a login wave.
+
+AUTH_EXECUTOR = None                # Created by StartAuthPool()
+AUTH_PENDING = 0                    # Hash/check jobs currently queued or running
+
+def StartAuthPool():
+    # Called first thing at startup, before any DB threads exist to be forked
+    global AUTH_EXECUTOR
+    AUTH_EXECUTOR = ProcessPoolExecutor(max_workers=AUTH_WORKERS)
+    AUTH_EXECUTOR.submit(bcrypt.gensalt).result() # Start the worker processes now
+    print(f'[STARTUP] Started {AUTH_WORKERS} password hashing workers.')
+
+async def RunAuth(func, *args):
+    # Runs a bcrypt function on the auth pool; returns None if the pool is saturated
+    global AUTH_PENDING
+    if AUTH_PENDING >= AUTH_QUEUE_LIMIT:
+        print('[RUN_AUTH] Auth pool saturated, rejecting request.')
+        return None
+
+    AUTH_PENDING += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(AUTH_EXECUTOR, func, *args)
+    finally:
+        AUTH_PENDING -= 1
 
-REGISTERED_LOTS = ["P6","P5"]
+#################################################### Session tokens
 
-#################################################### Server-side helper functions
+# Login hands out a session token so later account operations don't have to send the
+# password and pay for another bcrypt check. A token is "<session id>.<expiry>.<signature>",
+# is only accepted on the websocket that logged in, and stops working once it expires, is
+# revoked (Logout, password change, account deletion) or the connection closes.
 
-async def UpdCongAvg(lot, week, day, index):
-    print(f"[UPD_CONG_AVG] Updating congestion average for {lot}")
-    key = f"histData.{day}"
-    doc = SPOTS_COL.find_one({"lot_id": lot}, {key:1, "_id": 0})
-    congHist = doc["histData"][day]
+SESSIONS = {}                       # session id -> {"name", "websocket", "expires"}
+REVOKED_SESSIONS = {}               # session id -> expiry, for revoked tokens that haven't expired yet
 
-    sum = 0
-    divisor = 0
+def SignSession(payload):
+    return hmac.new(SESSION_SECRET, payload.encode('utf-8'), hashlib.sha256).hexdigest()
 
-    for i in range(0,4):
-        sum += congHist[i][index] if congHist[i][index] != -1 else 0
-        divisor += 1 if congHist[i][index] != -1 else 0
+def IssueSession(websocket, name):
+    sessionId = secrets.token_urlsafe(16)
+    expires = int(time.time()) + SESSION_TTL
+    payload = f"{sessionId}.{expires}"
 
-    # if no data exists for that day in any of the 4 weeks, set the average to 0
-    if divisor == 0:
-        avg = -1
-    else:
-        avg = sum / divisor
+    SESSIONS[sessionId] = {"name": name, "websocket": websocket, "expires": expires}
+    return f"{payload}.{SignSession(payload)}"
 
-    avg = sum / divisor
+def CheckSession(websocket, name, token):
+    try:
+        sessionId, expires, signature = token.split(".")
+        expires = int(expires)
+    except (AttributeError, ValueError):
+        return "invalid_token"
 
-    key = f"avgCong.{day}.{index}"
-    SPOTS_COL.update_one(
-        {"lot_id": lot},
-        {"$set": {key:avg}}
-    )
+    if not hmac.compare_digest(signature, SignSession(f"{sessionId}.{expires}")):
+        return "invalid_token"
 
-    print(f"[UPD_CONG_AVG] Successfully updated {lot}.")
+    if expires < time.time():
+        return "token_expired"
 
-async def UpdLotCongHist(lot, key):
-    doc = SPOTS_COL.find_one({"lot_id": lot}, {"congestion_percent": 1, "_id": 0})
-    currCong = doc["congestion_percent"]
-    SPOTS_COL.update_one(
-        {"lot_id": lot},
-        {"$set": {key: currCong}}
+    session = SESSIONS.get(sessionId)
+
+    if sessionId in REVOKED_SESSIONS or session is None:
+        return "invalid_token"
+
+    if session["websocket"] is not websocket or session["name"] != name:
+        return "invalid_token"
+
+    return "valid"
+
+def SessionId(token):
+    return token.split(".")[0] if isinstance(token, str) else None
+
+def RevokeSessions(name, keep=None):
+    # Revokes every session belonging to a user, except optionally the one in use
+    now = time.time()
+    for sessionId, expires in list(REVOKED_SESSIONS.items()):
+        if expires < now:
+            del REVOKED_SESSIONS[sessionId]
+
+    for sessionId, session in list(SESSIONS.items()):
+        if session["name"] == name and sessionId != keep:
+            REVOKED_SESSIONS[sessionId] = session["expires"]
+            del SESSIONS[sessionId]
+
+def RenameSessions(name, newName):
+    for session in SESSIONS.values():
+        if session["name"] == name:
+            session["name"] = newName
+
+def DropSessions(websocket):
+    # A token is tied to its connection, so it dies with it
+    for sessionId, session in list(SESSIONS.items()):
+        if session["websocket"] is websocket:
+            del SESSIONS[sessionId]
+
+async def AuthenticateRequest(name, passwd, websocket, token):
+    # Uses the session token when the client sent one, otherwise the password
+    if token is not None:
+        return CheckSession(websocket, name, token)
+
+    if not isinstance(passwd, str): # Neither a token nor a password
+        return "missing_credentials"
+
+    return await UserAuthenticate(name, passwd)
+
+#################################################### Lot registry
+
+# The lots the server knows about are listed in LOT_CONFIG rather than in code. Each entry
+# carries the lot's metadata, and its spaces are whichever spots the layout file (the
+# geometry generated by generate-spots.py) assigns to that lot. Adding a lot only takes a
+# new layout (a spec entry in lot-layout.json) and a new config entry; InitDB() creates its
+# document on the next start.
+# Every space has one permit class: the lot's "permit" (green if not given), unless the
+# lot's "permit_spaces" maps another class to inclusive [first, last] space_id ranges.
+
+LOT_REGISTRY = {}                   # lot_id -> {"name", "marker", "permit", "permitSpaces", "spaces"}, in config order
+
+def ParsePermitSpaces(lot):
+    # Returns {space_id: permit class index} for the lot's spaces outside its default class
+    permitSpaces = {}
+    for permit, ranges in lot.get("permit_spaces", {}).items():
+        for first, last in ranges:
+            for id in range(first, last + 1):
+                permitSpaces[id] = PERMITS.index(permit)
+    return permitSpaces
+
+def LoadLayout(path):
+    # Returns (lot_ids, space_ids, lot index of each spot, corner latitudes, corner longitudes),
+    # the corners as (spots, 4) arrays. Reads the columnar layout generate-spots.py writes, in
+    # JSON or binary form, or its legacy list of spots.
+    if path.endswith(".bin"):
+        with open(path, "rb") as layoutFile:
+            data = layoutFile.read()
+
+        if data[:8] != b"SPOTCOL1":
+            raise ValueError(f'{path} is not a binary spot layout')
+        headerLength, = struct.unpack_from("<I", data, 8)
+        header = json.loads(data[12:12 + headerLength])
+        count = header["count"]
+
+        offset = 12 + headerLength
+        columns = {"lots": header["lots"], "origin": header["origin"]}
+        for name, dtype, size in (("id", "<u4", count), ("lot", "<u2", count), ("block", "<u2", count), ("corners", "<f4", count * 8)):
+            columns[name] = np.frombuffer(data, dtype=dtype, count=size, offset=offset)
+            offset += columns[name].nbytes
+    else:
+        with open(path) as layoutFile:
+            columns = json.load(layoutFile)
+
+        if isinstance(columns, list):
+            lots = list(dict.fromkeys(spot["parkingLot"] for spot in columns))
+            return (
+                lots,
+                np.array([spot["id"] for spot in columns]),
+                np.array([lots.index(spot["parkingLot"]) for spot in columns]),
+                np.array([[corner["latitude"] for corner in spot["coordinates"][:4]] for spot in columns]),
+                np.array([[corner["longitude"] for corner in spot["coordinates"][:4]] for spot in columns])
+            )
+
+    corners = np.asarray(columns["corners"], dtype=np.float32).reshape(-1, 4, 2).astype(np.float64)
+    return (
+        columns["lots"],
+        np.asarray(columns["id"]),
+        np.asarray(columns["lot"]),
+        corners[:, :, 0] + columns["origin"][0],
+        corners[:, :, 1] + columns["origin"][1]
     )
 
-async def UpdCongHist():
-    print('[UPD_CONG_HIST] Updating congestion history!')
+def LoadLotRegistry(path=LOT_CONFIG):
+    print(f'[LOAD_LOTS] Loading lot registry from {path}...')
+
+    with open(path) as configFile:
+        config = json.load(configFile)
+
+    lots, ids, lotIndices, latitudes, longitudes = LoadLayout(os.path.join(os.path.dirname(path), config["layout"]))
+
+    lotSpaces = {lotId: ids[lotIndices == lotIndex].tolist() for lotIndex, lotId in enumerate(lots)}
 
-    currTime = datetime.now()
-    currDay = currTime.weekday() # 0 - 6, Monday - Sunday
-    currHour = currTime.hour
-    currMinute = currTime.minute
+    LOT_REGISTRY.clear()
+    for lot in config["lots"]:
+        LOT_REGISTRY[lot["lot_id"]] = {
+            "name": lot.get("name", lot["lot_id"]),
+            "marker": lot.get("marker"),
+            "permit": PERMITS.index(lot.get("permit", "green")),
+            "permitSpaces": ParsePermitSpaces(lot),
+            "spaces": sorted(lotSpaces.get(lot["lot_id"], []))
+        }
+
+    unregistered = set(lotSpaces) - set(LOT_REGISTRY)
+    if unregistered:
+        print(f'[LOAD_LOTS] Layout has spots for unregistered lots, ignoring them: {sorted(unregistered)}')
+
+    registered = np.isin(lotIndices, [lotIndex for lotIndex, lotId in enumerate(lots) if lotId in LOT_REGISTRY])
+    BuildSpatialIndex(ids[registered], latitudes[registered], longitudes[registered])
+
+    print(f'[LOAD_LOTS] Registered {len(LOT_REGISTRY)} lots with {sum(len(lot["spaces"]) for lot in LOT_REGISTRY.values())} spaces.')
+
+#################################################### Spatial index
 
-    currDayStr = "monday"    if currDay == 0 else   \
-                 "tuesday"   if currDay == 1 else   \
-                 "wednesday" if currDay == 2 else   \
-                 "thursday"  if currDay == 3 else   \
-                 "friday"
+# Spot centroids from the layout, projected to meters around the layout's center and
+# bucketed into a grid of GRID_CELL_SIZE squares. FindNearestFree() searches rings of cells
+# outward from the query point, so it only looks at spots near the query.
 
-    doc = SPOTS_COL.find_one({"lot_id": "P6"}, {"histData.weekNumber": 1, "_id": 0})
-    currWeekOfHist = doc["histData"]["weekNumber"] if doc else None
+GRID = {}                           # (cell x, cell y) -> space_ids with their centroid in that cell
+GRID_BOUNDS = (0, 0, 0, 0)          # Min/max cell x and y present in GRID
+SPOT_XY = {}                        # space_id -> (x, y) centroid in meters
+SPOT_LATLON = {}                    # space_id -> (latitude, longitude) centroid
+GRID_ORIGIN = (0.0, 0.0)            # (latitude, longitude) the projection is centered on
 
-    if currWeekOfHist == None:
-        print('[UPD_CONG_HIST] No document returned, doing nothing!')
+def ProjectToMeters(latitude, longitude):
+    # Equirectangular projection; plenty accurate across a campus
+    originLat, originLon = GRID_ORIGIN
+    x = (longitude - originLon) * 111320 * math.cos(math.radians(originLat))
+    y = (latitude - originLat) * 110540
+    return x, y
+
+def BuildSpatialIndex(ids, latitudes, longitudes):
+    # ids are the spots' space_ids; latitudes/longitudes are (spots, 4) arrays of their corners
+    global GRID_ORIGIN, GRID_BOUNDS
+    GRID.clear()
+    SPOT_XY.clear()
+    SPOT_LATLON.clear()
+
+    if len(ids) == 0:
         return
-    
-    currIndex = (currHour - 6) * 2 + (0 if currMinute >= 0 and currMinute < 30 else 1)
-
-    # Update each lot's congestion history and then calculate the average over 4 weeks
-    for lot in REGISTERED_LOTS:
-        key = f"histData.{currDayStr}.{currWeekOfHist}.{currIndex}"
-        await UpdLotCongHist(lot, key)
-
-        key = f"avgCong.{currDayStr}.{currIndex}"
-        await UpdCongAvg(lot, currWeekOfHist, currDayStr, currIndex)
-
-    # Increment current week of congestion history if its the last day of the week and the last time slot
-    if currDay == 4 and currIndex == 31:
-        newCurrWeek = currWeekOfHist + 1 if currWeekOfHist < 3 else 0
-        SPOTS_COL.update_one(
-            {"lot_id": "P6"},
-            {"$set": {"histData.weekNumber": newCurrWeek}}
-        )
 
-async def UpdCongHistLoop():
-    print('[STARTUP] Running congestion history update loop.')
+    centerLats = latitudes.mean(axis=1)
+    centerLons = longitudes.mean(axis=1)
+    GRID_ORIGIN = (float(centerLats.mean()), float(centerLons.mean()))
+
+    for id, latitude, longitude in zip(ids.tolist(), centerLats.tolist(), centerLons.tolist()):
+        x, y = ProjectToMeters(latitude, longitude)
+        SPOT_LATLON[id] = (latitude, longitude)
+        SPOT_XY[id] = (x, y)
+        GRID.setdefault((math.floor(x / GRID_CELL_SIZE), math.floor(y / GRID_CELL_SIZE)), []).append(id)
+
+    cellsX = [cell[0] for cell in GRID]
+    cellsY = [cell[1] for cell in GRID]
+    GRID_BOUNDS = (min(cellsX), max(cellsX), min(cellsY), max(cellsY))
+
+def RingCells(centerX, centerY, ring):
+    # Cells at exactly `ring` steps (Chebyshev distance) from the center cell, skipping
+    # the ones outside GRID_BOUNDS (which are all empty)
+    minX, maxX, minY, maxY = GRID_BOUNDS
+    fromX, toX = max(centerX - ring, minX), min(centerX + ring, maxX)
+    fromY, toY = max(centerY - ring + 1, minY), min(centerY + ring - 1, maxY)
+
+    for y in {centerY - ring, centerY + ring}: # One row when ring is 0
+        if minY <= y <= maxY:
+            for x in range(fromX, toX + 1):
+                yield x, y
+    for x in {centerX - ring, centerX + ring} if ring else ():
+        if minX <= x <= maxX:
+            for y in range(fromY, toY + 1):
+                yield x, y
+
+def NearestSpots(latitude, longitude, k, accept):
+    # Returns up to k (distance, space_id) pairs, nearest first, for spots where accept(id)
+    x, y = ProjectToMeters(latitude, longitude)
+    centerX, centerY = math.floor(x / GRID_CELL_SIZE), math.floor(y / GRID_CELL_SIZE)
+    minX, maxX, minY, maxY = GRID_BOUNDS
+    firstRing = max(minX - centerX, centerX - maxX, minY - centerY, centerY - maxY, 0) # Nearest ring touching the grid
+    maxRing = max(abs(centerX - minX), abs(centerX - maxX), abs(centerY - minY), abs(centerY - maxY))
+
+    best = [] # Max-heap of the k nearest so far, as (-distance, space_id)
+    for ring in range(firstRing, maxRing + 1):
+        # Nothing in this ring or beyond can be closer than this
+        if len(best) == k and (ring - 1) * GRID_CELL_SIZE > -best[0][0]:
+            break
+
+        for cell in RingCells(centerX, centerY, ring):
+            for id in GRID.get(cell, ()):
+                if not accept(id):
+                    continue
+
+                spotX, spotY = SPOT_XY[id]
+                distance = math.hypot(spotX - x, spotY - y)
+
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, id))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, id))
+
+    return sorted((-negDistance, id) for negDistance, id in best)
+
+#################################################### In-memory spot state
+
+# The server keeps an authoritative copy of every spot's status in memory so that
+# UpdateSpot/QuerySpot never have to search the lots collection. The table is loaded once
+# by LoadSpotState() at startup, and changes are written back to the DB in batches by
+# FlushSpotsLoop().
+
+NO_SPOT = 255                       # Marks an unused space_id in SPOT_STATUS
+
+SPOT_STATUS = bytearray()           # space_id -> status (0 = free, 1 = occupied, 2 = reserved)
+SPOT_LOT = array('H')               # space_id -> index into LOT_IDS
+SPOT_PERMIT = bytearray()           # space_id -> index into PERMITS
+LOT_IDS = []                        # lot index -> lot_id
+LOT_INDEX = {}                      # lot_id -> lot index
+LOT_SPACES = []                     # lot index -> array of the space_ids in that lot
+LOT_CONG = []                       # lot index -> current congestion_percent
+LOT_COUNTS = []                     # lot index -> [free, occupied, reserved] spot counts
+LOT_PERMIT_COUNTS = []              # lot index -> permit index -> [free, occupied, reserved] spot counts
+LOT_INFO = []                       # lot index -> the lot's other RefreshData fields (avgCong, ...)
+
+LOT_SUBSCRIBERS = []                # lot index -> websockets subscribed to that lot's deltas
+LOT_FIRST_ID = []                   # lot index -> lowest space_id in the lot
+LOT_PACKED = []                     # lot index -> 2-bit statuses for LOT_FIRST_ID.. (see PackLot)
+
+STATE_VERSION = 0                   # Bumped on every spot change
+CHANGE_LOG = deque(maxlen=CHANGE_LOG_SIZE) # (version, space_id) of the most recent changes
+
+DIRTY_SPOTS = {}                    # space_id -> status, changes not yet written to the DB
+DIRTY_LOTS = set()                  # lot indices whose congestion_percent has not been written
+FLUSH_LOCK = asyncio.Lock()
+
+async def LoadSpotState():
+    global SPOT_STATUS, SPOT_LOT, SPOT_PERMIT, STATE_VERSION
+    print('[LOAD_STATE] Loading spot state from the DB...')
+
+    lots = await FindAll(SPOTS_COL, {"lot_id": {"$in": list(LOT_REGISTRY)}}, {"_id": 0, "histData": 0})
+
+    if STORAGE_MODE == "spots": # Put each lot's spot documents back together
+        lotSpaces = {lot["lot_id"]: [] for lot in lots}
+        for spot in await FindAll(SPOT_DOCS_COL, {"lot_id": {"$in": list(lotSpaces)}}, {"_id": 0}):
+            lotSpaces[spot["lot_id"]].append({"space_id": spot["space_id"], "status": spot["status"]})
+        for lot in lots:
+            lot["spaces"] = sorted(lotSpaces[lot["lot_id"]], key=lambda spot: spot["space_id"])
+
+    registryOrder = {lotId: position for position, lotId in enumerate(LOT_REGISTRY)}
+    lots.sort(key=lambda lot: registryOrder[lot["lot_id"]])
+    maxId = max((spot["space_id"] for lot in lots for spot in lot["spaces"]), default=0)
+
+    SPOT_STATUS = bytearray([NO_SPOT]) * (maxId + 1)
+    SPOT_LOT = array('H', bytes(2 * (maxId + 1)))
+    SPOT_PERMIT = bytearray(maxId + 1)
+    LOT_IDS.clear()
+    LOT_INDEX.clear()
+    LOT_SPACES.clear()
+    LOT_CONG.clear()
+    LOT_COUNTS.clear()
+    LOT_PERMIT_COUNTS.clear()
+    LOT_INFO.clear()
+    LOT_SUBSCRIBERS.clear()
+    LOT_FIRST_ID.clear()
+    LOT_PACKED.clear()
+    CHANGE_LOG.clear()
+    DIRTY_SPOTS.clear()
+    DIRTY_LOTS.clear()
+
+    # Versions start from the clock so they keep increasing across server restarts; workers
+    # all start from the supervisor's clock so their versions stay in step
+    STATE_VERSION = int(os.environ.get("SPOTME_EPOCH", time.time())) << 20
+
+    for lotIndex, lot in enumerate(lots):
+        LOT_IDS.append(lot["lot_id"])
+        LOT_INDEX[lot["lot_id"]] = lotIndex
+        LOT_SPACES.append(array('I', (spot["space_id"] for spot in lot["spaces"])))
+        counts = [0, 0, 0]
+        permitCounts = [[0, 0, 0] for _ in PERMITS]
+        registered = LOT_REGISTRY[lot["lot_id"]]
+
+        for spot in lot["spaces"]:
+            permit = registered["permitSpaces"].get(spot["space_id"], registered["permit"])
+            SPOT_STATUS[spot["space_id"]] = spot["status"]
+            SPOT_LOT[spot["space_id"]] = lotIndex
+            SPOT_PERMIT[spot["space_id"]] = permit
+            counts[spot["status"]] += 1
+            permitCounts[permit][spot["status"]] += 1
+
+        LOT_COUNTS.append(counts)
+        LOT_PERMIT_COUNTS.append(permitCounts)
+        LOT_INFO.append({key: value for key, value in lot.items() if key not in ("lot_id", "spaces", "congestion_percent")})
+        LOT_SUBSCRIBERS.append(set())
+        LOT_FIRST_ID.append(min(LOT_SPACES[lotIndex], default=0))
+        LOT_PACKED.append(PackLot(lotIndex))
+        LOT_CONG.append((counts[1] + counts[2]) / len(lot["spaces"]) if lot["spaces"] else 0)
+
+    REFRESH_FRAGMENTS[:] = [None] * len(LOT_IDS)
+    REFRESH_DIRTY.update(range(len(LOT_IDS)))
+
+    print(f'[LOAD_STATE] Loaded {sum(len(s) for s in LOT_SPACES)} spots in {len(LOT_IDS)} lots.')
+
+def GetSpotStatus(id):
+    # Returns the in-memory status of a spot, or None if no such spot exists
+    if type(id) is not int or id < 0 or id >= len(SPOT_STATUS):
+        return None
+
+    status = SPOT_STATUS[id]
+    return None if status == NO_SPOT else status
+
+def SetSpotStatus(id, status):
+    global STATE_VERSION
+    # Checked before any counter moves, so a bad status can't leave the counts half-updated
+    if GetSpotStatus(id) is None or type(status) is not int or status not in (0, 1, 2):
+        raise ValueError(f'Invalid spot status update: {id!r} -> {status!r}')
+    lotIndex = SPOT_LOT[id]
+
+    # Moves the spot between its lot's free/occupied/reserved counters (overall and for
+    # its permit class), so congestion and availability never need a rescan of the lot
+    counts = LOT_COUNTS[lotIndex]
+    counts[SPOT_STATUS[id]] -= 1
+    counts[status] += 1
+    permitCounts = LOT_PERMIT_COUNTS[lotIndex][SPOT_PERMIT[id]]
+    permitCounts[SPOT_STATUS[id]] -= 1
+    permitCounts[status] += 1
+
+    # Patch the spot's two bits in the lot's packed snapshot
+    offset = id - LOT_FIRST_ID[lotIndex]
+    shift = (offset % 4) * 2
+    packed = LOT_PACKED[lotIndex]
+    packed[offset // 4] = (packed[offset // 4] & ~(3 << shift)) | (status << shift)
+
+    STATE_VERSION += 1
+    CHANGE_LOG.append((STATE_VERSION, id))
+    REFRESH_DIRTY.add(lotIndex)
+
+    SPOT_STATUS[id] = status
+    if IS_LEADER: # Only the leader writes spot state back to the DB
+        DIRTY_SPOTS[id] = status
+        DIRTY_LOTS.add(lotIndex)
+
+async def FlushSpots():
+    # Writes every pending spot change to the DB: one update per spot document in "spots"
+    # storage, or one update per lot in "lots" storage. Flushes are serialized so an older
+    # batch can never land on top of a newer one.
+    async with FLUSH_LOCK:
+        if not DIRTY_SPOTS and not DIRTY_LOTS:
+            return
+
+        spots = DIRTY_SPOTS.copy()
+        lots = DIRTY_LOTS.copy()
+        DIRTY_SPOTS.clear()
+        DIRTY_LOTS.clear()
+
+        updates = {lotIndex: ({}, []) for lotIndex in lots}
+        spotRequests = []
+
+        for id, status in spots.items():
+            if STORAGE_MODE == "spots":
+                spotRequests.append(pymongo.UpdateOne({"space_id": id}, {"$set": {"status": status}}))
+                updates.setdefault(SPOT_LOT[id], ({}, []))
+                continue
+
+            fields, arrayFilters = updates.setdefault(SPOT_LOT[id], ({}, []))
+            fields[f"spaces.$[s{id}].status"] = status
+            arrayFilters.append({f"s{id}.space_id": id})
+
+        requests = []
+        for lotIndex, (fields, arrayFilters) in updates.items():
+            fields["congestion_percent"] = LOT_CONG[lotIndex]
+            requests.append(pymongo.UpdateOne(
+                {"lot_id": LOT_IDS[lotIndex]},
+                {"$set": fields},
+                array_filters=arrayFilters or None
+            ))
+
+        try:
+            if spotRequests:
+                await RunDB(SPOT_DOCS_COL.bulk_write, spotRequests, ordered=False)
+            await RunDB(SPOTS_COL.bulk_write, requests, ordered=False)
+        except Exception as e:
+            print(f'[FLUSH_SPOTS] Write failed, will retry: {e}')
+
+            # Requeue the failed changes without clobbering anything newer
+            for id, status in spots.items():
+                DIRTY_SPOTS.setdefault(id, status)
+            DIRTY_LOTS.update(updates.keys())
+
+async def FlushSpotsLoop():
+    print('[STARTUP] Running spot write-behind loop.')
     while True:
-        await asyncio.sleep(60)
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await FlushSpots()
+
+#################################################### Versioned compact snapshots
+
+# A lot's snapshot is its statuses packed four to a byte, covering every space_id from
+# LOT_FIRST_ID up to the lot's last spot. Spot N of the range lives in byte N // 4 at bit
+# (N % 4) * 2. Unused ids inside the range are packed as 3. Every change bumps
+# STATE_VERSION, so a client that remembers the version of its last snapshot can ask for
+# just the spots that changed since then.
+
+def PackLot(lotIndex):
+    spaces = LOT_SPACES[lotIndex]
+    if not spaces:
+        return bytearray()
+
+    firstId = min(spaces)
+    count = max(spaces) - firstId + 1
+    packed = bytearray(b'\xff') * ((count + 3) // 4) # Every id starts out unused (3)
+
+    for id in spaces:
+        offset = id - firstId
+        shift = (offset % 4) * 2
+        packed[offset // 4] = (packed[offset // 4] & ~(3 << shift)) | (SPOT_STATUS[id] << shift)
+
+    return packed
+
+def EncodeLot(lotIndex):
+    spaces = LOT_SPACES[lotIndex]
+    return {
+        "lot_id": LOT_IDS[lotIndex],
+        "first_id": LOT_FIRST_ID[lotIndex],
+        "count": max(spaces) - LOT_FIRST_ID[lotIndex] + 1 if spaces else 0,
+        "congestion_percent": LOT_CONG[lotIndex],
+        "bits": base64.b64encode(LOT_PACKED[lotIndex]).decode('ascii')
+    }
+
+def ChangedSince(version):
+    # Returns the ids of spots changed after the given version, or None if the change log
+    # no longer reaches back that far
+    if version > STATE_VERSION:
+        return None
+    if version == STATE_VERSION:
+        return set()
+    if not CHANGE_LOG or CHANGE_LOG[0][0] > version + 1:
+        return None
+
+    changed = set()
+    for changeVersion, id in reversed(CHANGE_LOG):
+        if changeVersion <= version:
+            break
+        changed.add(id)
+    return changed
+
+#################################################### RefreshData cache
+
+# RefreshData replies are served from a cached, already-encoded message. Each lot's part of
+# the "data" string is kept pre-escaped in REFRESH_FRAGMENTS, and only lots that changed are
+# re-encoded. Rebuilds happen at most once per REFRESH_COALESCE seconds, however many
+# clients are refreshing.
+
+REFRESH_FRAGMENTS = []              # lot index -> escaped JSON of the lot, or None
+REFRESH_DIRTY = set()               # lot indices whose fragment is out of date
+REFRESH_PAYLOAD = None              # Complete RefreshData reply text
+REFRESH_BUILT = 0                   # time.monotonic() of the last rebuild
+
+def RefreshLotFragment(lotIndex):
+    lot = {
+        "lot_id": LOT_IDS[lotIndex],
+        "congestion_percent": LOT_CONG[lotIndex],
+        **LOT_INFO[lotIndex],
+        "spaces": [{"space_id": id, "status": SPOT_STATUS[id]} for id in LOT_SPACES[lotIndex]]
+    }
+    # Encoding twice and dropping the quotes yields the lot as it appears inside the data string
+    return json.dumps(json.dumps(lot))[1:-1]
+
+def RefreshPayload():
+    global REFRESH_PAYLOAD, REFRESH_BUILT
+    now = time.monotonic()
+
+    if REFRESH_PAYLOAD is None or (REFRESH_DIRTY and now - REFRESH_BUILT >= REFRESH_COALESCE):
+        for lotIndex in REFRESH_DIRTY:
+            REFRESH_FRAGMENTS[lotIndex] = RefreshLotFragment(lotIndex)
+        REFRESH_DIRTY.clear()
 
-        currTime = datetime.now()
+        data = "[" + ", ".join(REFRESH_FRAGMENTS) + "]"
+        REFRESH_PAYLOAD = '{"op": "RefreshData", "status": "data_retrieved", "data": "' + data + '"}'
+        REFRESH_BUILT = now
 
-        if currTime.weekday() == 5 or currTime.weekday() == 6: # Ignore weekends
+    return REFRESH_PAYLOAD
+
+#################################################### Spot change subscriptions
+
+# Clients that call Subscribe get one snapshot of the lots they asked for (with its
+# version), and then a SpotDelta message for every spot change in those lots instead of
+# polling RefreshData.
+
+def AddSubscriber(websocket, lotIndices):
+    RemoveSubscriber(websocket)
+    for lotIndex in lotIndices:
+        LOT_SUBSCRIBERS[lotIndex].add(websocket)
+
+def RemoveSubscriber(websocket):
+    for subscribers in LOT_SUBSCRIBERS:
+        subscribers.discard(websocket)
+
+def LotSnapshot(lotIndex):
+    return {
+        "lot_id": LOT_IDS[lotIndex],
+        "congestion_percent": LOT_CONG[lotIndex],
+        "spaces": [{"space_id": id, "status": SPOT_STATUS[id]} for id in LOT_SPACES[lotIndex]]
+    }
+
+def NotifySubscribers(id):
+    lotIndex = SPOT_LOT[id]
+    subscribers = LOT_SUBSCRIBERS[lotIndex]
+    if not subscribers:
+        return
+
+    delta = json.dumps({
+        "op": "SpotDelta",
+        "lot_id": LOT_IDS[lotIndex],
+        "space_id": id,
+        "status": SPOT_STATUS[id],
+        "congestion_percent": LOT_CONG[lotIndex],
+        "version": STATE_VERSION
+    })
+    for websocket in subscribers: # Never blocks; see Connection limits and outbound queues
+        Send(websocket, delta, "push")
+
+#################################################### Reservations
+
+# Active ReserveSpot holds are kept in a heap ordered by expiry, and ReservationLoop() sleeps
+# until the earliest one is due rather than polling each spot. If a reserved spot becomes
+# occupied, ApplySpotUpdate() ends its reservation straight away. Holds are also stored in
+# the reservations collection, so they can be restored (or released) after a restart.
+# With several workers every worker keeps the holds, but only the leader keeps the heap; it
+# publishes the release of due holds so every worker frees the spots in the same order.
+
+RESERVATIONS = {}                   # space_id -> {"websocket", "reqId", "expires"}
+RESERVATION_HEAP = []               # (expires, space_id), earliest first; stale entries are skipped (leader only)
+ENDED_RESERVATIONS = []             # (space_id, expires) of ended holds still stored in the DB
+RESERVATION_WAKEUP = asyncio.Event() # Set when a hold is added ahead of the current earliest one
+
+async def SendReservationStatus(websocket, spotId, status, reqId=None):
+    if websocket is None: # Restored after a restart; the owner is gone
+        return
+
+    reply = {"op": "ReserveSpot", "id": spotId, "status":status}
+    if reqId is not None:
+        reply["reqId"] = reqId
+
+    if not Send(websocket, json.dumps(reply)):
+        print(f"[RESERVATION] Owner of spot {spotId} disconnected before '{status}' was sent.")
+
+def AddReservation(spotId, websocket, expires, reqId=None):
+    RESERVATIONS[spotId] = {"websocket": websocket, "reqId": reqId, "expires": expires}
+    if not IS_LEADER:
+        return
+
+    heapq.heappush(RESERVATION_HEAP, (expires, spotId))
+
+    if RESERVATION_HEAP[0][1] == spotId:
+        RESERVATION_WAKEUP.set()
+
+def ReservationTaken(spotId):
+    # Called whenever a spot becomes occupied
+    reservation = RESERVATIONS.pop(spotId, None)
+    if reservation is None:
+        return
+
+    print(f"[RESERVATION] Spot {spotId} was taken mid-reservation!")
+    if IS_LEADER:
+        ENDED_RESERVATIONS.append((spotId, reservation["expires"]))
+    asyncio.create_task(SendReservationStatus(reservation["websocket"], spotId, "taken", reservation["reqId"]))
+
+async def ReleaseExpiredReservations():
+    # Leader only: publishes the holds that are due; ReleaseReservations() frees them
+    now = time.time()
+    due = []
+
+    while RESERVATION_HEAP and RESERVATION_HEAP[0][0] <= now:
+        expires, spotId = heapq.heappop(RESERVATION_HEAP)
+        reservation = RESERVATIONS.get(spotId)
+
+        if reservation is None or reservation["expires"] != expires: # Taken or replaced since
             continue
-        if currTime.hour < 6 or currTime.hour >= 22: # Ignore times outside of 6am - 10pm
+
+        due.append([spotId, expires])
+
+    try:
+        released = await Publish({"type": "release", "holds": due}) if due else 0
+    except Exception:
+        for spotId, expires in due: # Put them back so the next pass tries again
+            heapq.heappush(RESERVATION_HEAP, (expires, spotId))
+        raise
+
+    if ENDED_RESERVATIONS:
+        ended = ENDED_RESERVATIONS[:]
+        ENDED_RESERVATIONS.clear()
+        try:
+            await RunDB(RESV_COL.delete_many, {"$or": [{"space_id": spotId, "expires": expires} for spotId, expires in ended]})
+        except Exception:
+            ENDED_RESERVATIONS.extend(ended) # Deleted on a later pass
+            raise
+
+    if released:
+        await FlushSpots()
+        print(f"[RESERVATION] Released {released} expired reservations.")
+
+async def ReleaseReservations(holds):
+    # Ends the [space_id, expires] holds that are still current and frees their spots;
+    # returns how many spots were freed
+    expired = []
+
+    for spotId, expires in holds:
+        reservation = RESERVATIONS.get(spotId)
+
+        if reservation is None or reservation["expires"] != expires: # Taken or replaced since
             continue
-        if currTime.minute != 0 and currTime.minute != 30: # Ignore times that aren't X:00 or X:30
+
+        del RESERVATIONS[spotId]
+        if IS_LEADER:
+            ENDED_RESERVATIONS.append((spotId, expires))
+        expired.append((spotId, reservation))
+
+    # Frees the spots still held; 2 -> 0 is normally refused, so the rules are skipped here
+    released = [
+        spotId for spotId, _ in expired
+        if TransitionSpot(spotId, 0, expected=2, enforceRules=False)[0] == "spot_updated"
+    ]
+    lotSpots = {SPOT_LOT[spotId]: spotId for spotId in released}
+
+    for spotId in lotSpots.values():
+        await CongestionCalc(spotId)
+
+    for spotId in released:
+        NotifySubscribers(spotId)
+
+    for spotId, reservation in expired:
+        asyncio.create_task(SendReservationStatus(reservation["websocket"], spotId, "time_limit_reached", reservation["reqId"]))
+
+    return len(released)
+
+async def LoadReservations():
+    # Restores holds that outlived a restart and frees any reserved spot without one
+    now = time.time()
+    records = await FindAll(RESV_COL, {}, {"_id": 0})
+
+    if IS_WORKER:
+        # The supervisor already released what was stranded. Every worker restores the same
+        # holds, due or not, and leaves expiring them to the leader.
+        for r in records:
+            if GetSpotStatus(r["space_id"]) == 2:
+                AddReservation(r["space_id"], None, r["expires"])
+        print(f"[LOAD_RESV] Restored {len(RESERVATIONS)} reservations.")
+        return
+
+    active = {r["space_id"]: r["expires"] for r in records if r["expires"] > now and GetSpotStatus(r["space_id"]) == 2}
+
+    for spotId, expires in active.items():
+        AddReservation(spotId, None, expires)
+
+    stranded = [spotId for spotId, status in enumerate(SPOT_STATUS) if status == 2 and spotId not in active]
+    lotSpots = {SPOT_LOT[spotId]: spotId for spotId in stranded}
+
+    for spotId in stranded:
+        SetSpotStatus(spotId, 0)
+
+    for spotId in lotSpots.values():
+        await CongestionCalc(spotId)
+
+    await RunDB(RESV_COL.delete_many, {"space_id": {"$nin": list(active)}})
+    await FlushSpots()
+    print(f"[LOAD_RESV] Restored {len(active)} reservations, released {len(stranded)} stranded spots.")
+
+async def ReservationLoop():
+    print('[STARTUP] Running reservation manager.')
+    while True:
+        timeout = RESERVATION_TIME
+        if RESERVATION_HEAP:
+            timeout = max(0, RESERVATION_HEAP[0][0] - time.time())
+
+        RESERVATION_WAKEUP.clear()
+        try:
+            await asyncio.wait_for(RESERVATION_WAKEUP.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        try:
+            await ReleaseExpiredReservations()
+        except Exception as e: # Keep the manager alive; whatever failed is retried next pass
+            print(f'[RESERVATION] Releasing expired reservations failed, will retry: {e}')
+
+#################################################### Congestion history
+
+# Congestion is sampled every half hour from 6am to 10pm on weekdays (HIST_SLOTS slots a
+# day). Each lot's samples for a day are stored as one document in the congestion_history
+# collection, and history is never discarded. In memory, all of it lives in HIST, a
+# lots x days x slots NumPy array with NaN where nothing was recorded. That lets
+# UpdCongAvgs() recompute every lot's avgCong in one vectorized pass over any window in
+# HIST_WINDOWS.
+
+HIST_SLOTS = 32                     # Half-hour slots from 6am to 10pm
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday"]
+
+HIST = np.full((0, 0, HIST_SLOTS), np.nan, dtype=np.float32) # lot index x day x slot
+HIST_FIRST_DAY = date.today().toordinal() # Date ordinal of HIST's first day column
+HIST_DAYS = 0                       # Day columns of HIST in use
+HIST_LAST_MISSED = None             # Time of the latest slot marked missed, or None
+
+def HistDayIndex(day):
+    # Returns the HIST column for a date, growing the array if it's past the end
+    global HIST, HIST_DAYS
+    dayIndex = day.toordinal() - HIST_FIRST_DAY
+
+    if dayIndex >= HIST.shape[1]:
+        grown = np.full((HIST.shape[0], max(2 * HIST.shape[1], dayIndex + 1), HIST_SLOTS), np.nan, dtype=np.float32)
+        grown[:, :HIST.shape[1]] = HIST
+        HIST = grown
+
+    HIST_DAYS = max(HIST_DAYS, dayIndex + 1)
+    return dayIndex
+
+async def LoadHistory():
+    global HIST, HIST_FIRST_DAY, HIST_DAYS, HIST_LAST_MISSED
+    print('[LOAD_HIST] Loading congestion history...')
+
+    if not IS_WORKER and await RunDB(HIST_COL.count_documents, {}) == 0: # Workers find it imported
+        await ImportLegacyHistory()
+
+    records = await FindAll(HIST_COL, {}, {"_id": 0})
+    days = [date.fromisoformat(r["date"]).toordinal() for r in records]
+
+    HIST_FIRST_DAY = min(days + [date.today().toordinal()])
+    HIST_DAYS = 0
+    HIST = np.full((len(LOT_IDS), date.today().toordinal() - HIST_FIRST_DAY + 1, HIST_SLOTS), np.nan, dtype=np.float32)
+    HIST_LAST_MISSED = None
+
+    for record, day in zip(records, days):
+        lotIndex = LOT_INDEX.get(record["lot_id"])
+        if lotIndex is None:
             continue
 
-        await UpdCongHist()
+        dayIndex = HistDayIndex(date.fromordinal(day))
+        for slot, congestion in record.get("slots", {}).items():
+            HIST[lotIndex, dayIndex, int(slot)] = congestion
+
+        if record.get("missed"):
+            NoteMissedSlot(HistSlotTime(date.fromordinal(day), max(record["missed"])))
+
+    print(f'[LOAD_HIST] Loaded {len(records)} days of lot history.')
+    if not IS_WORKER: # The supervisor backfilled before starting the workers
+        await BackfillHistory()
+
+async def ImportLegacyHistory():
+    # Moves the old 4-week histData ring stored in the lot documents into congestion_history.
+    # Ring entry weekNumber is the current week, the one before it last week, and so on;
+    # except that the current week's entries for times still ahead of now haven't been
+    # overwritten yet, so they are from 4 weeks ago. The old loop moved weekNumber on after
+    # Friday's last slot, so from then until Monday it already points at next week.
+    lots = await FindAll(SPOTS_COL, {"histData": {"$exists": True}}, {"_id": 0, "lot_id": 1, "histData": 1})
+    currWeek = next((lot["histData"]["weekNumber"] for lot in lots if "weekNumber" in lot["histData"]), None)
+
+    if currWeek is None:
+        return
+
+    now = datetime.now()
+    monday = now.date() - timedelta(days=now.weekday())
+    if now > HistSlotTime(monday + timedelta(days=4), HIST_SLOTS - 1):
+        monday += timedelta(weeks=1)
+    requests = []
+
+    for lot in lots:
+        for dayNum, day in enumerate(WEEKDAYS):
+            for week, congHist in enumerate(lot["histData"].get(day, [])):
+                histDate = monday - timedelta(weeks=(currWeek - week) % 4) + timedelta(days=dayNum)
+                days = {} # date -> slots
+
+                for slot, congestion in enumerate(congHist):
+                    if congestion == -1:
+                        continue
+
+                    slotTime = HistSlotTime(histDate, slot)
+                    slotDate = histDate - timedelta(weeks=4) if slotTime > now else histDate
+                    days.setdefault(slotDate, {})[str(slot)] = congestion
+
+                for slotDate, slots in days.items():
+                    requests.append(pymongo.InsertOne({"lot_id": lot["lot_id"], "date": slotDate.isoformat(), "slots": slots}))
+
+    if requests:
+        await RunDB(HIST_COL.bulk_write, requests, ordered=False)
+        print(f'[LOAD_HIST] Imported {len(requests)} days of legacy history.')
+
+def HistSlotIndex(slotTime):
+    return (slotTime.hour - 6) * 2 + slotTime.minute // 30
+
+def NextHistSlot(after):
+    # Returns the first sampling time (weekdays, 6:00 to 21:30, on the hour or half hour)
+    # strictly after the given datetime
+    slotTime = after.replace(second=0, microsecond=0)
+    slotTime = slotTime.replace(minute=30) if slotTime.minute < 30 else slotTime.replace(minute=0) + timedelta(hours=1)
+
+    while slotTime.weekday() >= 5 or slotTime.hour < 6 or slotTime.hour >= 22:
+        if slotTime.hour < 6:
+            slotTime = slotTime.replace(hour=6, minute=0)
+        else: # Evening or weekend, so move on to 6am the next day
+            slotTime = (slotTime + timedelta(days=1)).replace(hour=6, minute=0)
+
+    return slotTime
+
+def HistSlotTime(day, slot):
+    return datetime(day.year, day.month, day.day, 6 + slot // 2, 30 * (slot % 2))
+
+def NoteMissedSlot(slotTime):
+    global HIST_LAST_MISSED
+    if HIST_LAST_MISSED is None or slotTime > HIST_LAST_MISSED:
+        HIST_LAST_MISSED = slotTime
+
+def LastHistSlot():
+    # Returns the time of the latest slot that was recorded or marked missed, or None
+    recorded = ~np.isnan(HIST[:, :HIST_DAYS]).all(axis=0) # day x slot
+    if not recorded.any():
+        return HIST_LAST_MISSED
+
+    latest = np.flatnonzero(recorded.ravel())[-1]
+    dayIndex, slot = divmod(int(latest), HIST_SLOTS)
+    latestRecorded = HistSlotTime(date.fromordinal(HIST_FIRST_DAY + dayIndex), slot)
+    return max(latestRecorded, HIST_LAST_MISSED or latestRecorded)
+
+async def BackfillHistory():
+    # Deals with the slots that passed while the server was down: the first
+    # HIST_BACKFILL_LIMIT get the congestion the lots had at shutdown, the rest are marked
+    # missed so they are never mistaken for slots that simply weren't recorded yet
+    lastSlot = LastHistSlot()
+    if lastSlot is None:
+        return
+
+    missed = []
+    slotTime = NextHistSlot(lastSlot)
+    while (datetime.now() - slotTime).total_seconds() > HIST_GRACE:
+        missed.append(slotTime)
+        slotTime = NextHistSlot(slotTime)
+
+    if not missed:
+        return
+
+    for slotTime in missed[:HIST_BACKFILL_LIMIT]:
+        await RecordHistSlot(slotTime.date(), HistSlotIndex(slotTime), list(LOT_CONG))
+
+    await MarkMissedSlots(missed[HIST_BACKFILL_LIMIT:])
+    print(f'[LOAD_HIST] Backfilled {min(len(missed), HIST_BACKFILL_LIMIT)} slots, marked {max(0, len(missed) - HIST_BACKFILL_LIMIT)} missed.')
+
+async def MarkMissedSlots(slotTimes):
+    for slotTime in slotTimes:
+        NoteMissedSlot(slotTime)
+
+    if not slotTimes or not IS_LEADER:
+        return
+
+    days = {}
+    for slotTime in slotTimes:
+        days.setdefault(slotTime.date().isoformat(), []).append(HistSlotIndex(slotTime))
+
+    requests = [
+        pymongo.UpdateOne(
+            {"lot_id": lotId, "date": day},
+            {"$addToSet": {"missed": {"$each": slots}}},
+            upsert=True
+        )
+        for lotId in LOT_IDS for day, slots in days.items()
+    ]
+    await RunDB(HIST_COL.bulk_write, requests, ordered=False)
+
+async def RecordHistSlot(day, slot, congestions):
+    # Stores one slot's congestion for every lot (congestions is indexed by lot index)
+    dayIndex = HistDayIndex(day)
+    HIST[:len(congestions), dayIndex, slot] = congestions
+
+    requests = [
+        pymongo.UpdateOne(
+            {"lot_id": LOT_IDS[lotIndex], "date": day.isoformat()},
+            {"$set": {f"slots.{slot}": congestion}},
+            upsert=True
+        )
+        for lotIndex, congestion in enumerate(congestions)
+    ]
+    if IS_LEADER: # Every worker keeps its own HIST; one copy goes to the DB
+        await RunDB(HIST_COL.bulk_write, requests, ordered=False)
+
+def HistAverages(windowDays):
+    # Mean congestion per lot, weekday and slot over the last windowDays days (including
+    # today), as a lots x 5 x HIST_SLOTS array with -1 where there is no data
+    end = date.today().toordinal() - HIST_FIRST_DAY + 1
+    start = max(0, end - windowDays)
+    window = HIST[:, start:min(end, HIST.shape[1])]
+
+    dayOrdinals = HIST_FIRST_DAY + np.arange(start, start + window.shape[1])
+    weekdays = (dayOrdinals - 1) % 7 # Ordinal 1 (0001-01-01) was a Monday
+    weekdayMask = (weekdays[:, None] == np.arange(len(WEEKDAYS))[None, :]).astype(np.float64)
+
+    recorded = ~np.isnan(window)
+    sums = np.einsum('lds,dw->lws', np.where(recorded, window, 0).astype(np.float64), weekdayMask)
+    counts = np.einsum('lds,dw->lws', recorded.astype(np.float64), weekdayMask)
+
+    return np.where(counts > 0, sums / np.maximum(counts, 1), -1)
+
+async def UpdCongAvgs(window=CONG_AVG_WINDOW):
+    print(f"[UPD_CONG_AVG] Updating congestion averages ({window})")
+    averages = HistAverages(HIST_WINDOWS[window])
+    requests = []
+
+    for lotIndex in range(averages.shape[0]):
+        avgCong = {day: [round(float(avg), 4) for avg in averages[lotIndex, dayNum]] for dayNum, day in enumerate(WEEKDAYS)}
+
+        LOT_INFO[lotIndex]["avgCong"] = avgCong # Keep the RefreshData cache current
+        REFRESH_DIRTY.add(lotIndex)
+        requests.append(pymongo.UpdateOne({"lot_id": LOT_IDS[lotIndex]}, {"$set": {"avgCong": avgCong}}))
+
+    if requests and IS_LEADER:
+        await RunDB(SPOTS_COL.bulk_write, requests, ordered=False)
+
+    print(f"[UPD_CONG_AVG] Updated {len(requests)} lots.")
+
+#################################################### Congestion forecasts
+
+# Forecasts for the next FORECAST_SLOTS sampling slots of every lot are computed together
+# with NumPy and cached, so PredictCongestion never computes anything itself. A lot's
+# forecast for a slot is its historical average for that weekday and slot, shifted by how
+# far today's live congestion is from the current slot's average. That shift fades by
+# FORECAST_DECAY per slot. With no history for a slot, the recent trend of today's samples
+# is extrapolated from the live congestion instead.
+
+FORECASTS = {}                      # lot_id -> [{"time", "congestion"}, ...]
+FORECAST_PAYLOAD = None             # Cached encoded reply for requests without filters
+FORECAST_TIME = None                # When the cached forecasts were made
+
+def CurrentHistSlot(now):
+    # Returns the time of the sampling slot that contains now, or None outside sampling hours
+    if now.weekday() >= 5 or now.hour < 6 or now.hour >= 22:
+        return None
+    return now.replace(minute=30 if now.minute >= 30 else 0, second=0, microsecond=0)
+
+def UpdateForecasts():
+    global FORECAST_PAYLOAD, FORECAST_TIME
+    now = datetime.now()
+    averages = HistAverages(HIST_WINDOWS[CONG_AVG_WINDOW]) # lot x weekday x slot, -1 = no data
+    live = np.array(LOT_CONG, dtype=np.float64)
+
+    slotTimes = []
+    slotTime = now
+    for _ in range(FORECAST_SLOTS):
+        slotTime = NextHistSlot(slotTime)
+        slotTimes.append(slotTime)
+
+    weekdays = np.array([t.weekday() for t in slotTimes])
+    slots = np.array([HistSlotIndex(t) for t in slotTimes])
+    baseline = averages[:, weekdays, slots] # lot x horizon
+
+    # Today's deviation from the usual congestion at this time of day
+    currentSlot = CurrentHistSlot(now)
+    if currentSlot is not None:
+        currentAvg = averages[:, currentSlot.weekday(), HistSlotIndex(currentSlot)]
+        deviation = np.where(currentAvg >= 0, live - currentAvg, 0)
+    else:
+        deviation = np.zeros_like(live)
+
+    # Recent per-slot trend from today's last few samples
+    trend = np.zeros_like(live)
+    todayIndex = date.today().toordinal() - HIST_FIRST_DAY
+    if 0 <= todayIndex < HIST_DAYS:
+        today = HIST[:, todayIndex].astype(np.float64)
+        recorded = np.flatnonzero(~np.isnan(today).all(axis=0))
+        if len(recorded) >= 2:
+            first, last = recorded[max(0, len(recorded) - 3)], recorded[-1]
+            trend = np.nan_to_num((today[:, last] - today[:, first]) / (last - first))
+
+    decay = FORECAST_DECAY ** np.arange(1, FORECAST_SLOTS + 1)
+    fromHistory = baseline + deviation[:, None] * decay[None, :]
+    fromTrend = live[:, None] + trend[:, None] * np.arange(1, FORECAST_SLOTS + 1)[None, :] * decay[None, :]
+    forecast = np.clip(np.where(baseline >= 0, fromHistory, fromTrend), 0, 1)
+
+    FORECASTS.clear()
+    for lotIndex, lotId in enumerate(LOT_IDS):
+        FORECASTS[lotId] = [
+            {"time": t.isoformat(timespec='minutes'), "congestion": round(float(c), 4)}
+            for t, c in zip(slotTimes, forecast[lotIndex])
+        ]
+
+    FORECAST_TIME = now.isoformat(timespec='seconds')
+    FORECAST_PAYLOAD = json.dumps({"op": "PredictCongestion", "status": "forecast_ready", "generated": FORECAST_TIME, "data": FORECASTS})
+
+async def ForecastLoop():
+    print('[STARTUP] Running congestion forecast loop.')
+    while True:
+        UpdateForecasts()
+        await asyncio.sleep(FORECAST_INTERVAL)
+
+#################################################### Server-side helper functions
+
+async def UpdCongHist(slotTime):
+    print(f'[UPD_CONG_HIST] Updating congestion history for {slotTime:%a %H:%M}!')
+
+    # Record every lot's congestion for this slot, then recalculate all of the averages
+    await RecordHistSlot(slotTime.date(), HistSlotIndex(slotTime), list(LOT_CONG))
+    await UpdCongAvgs()
+    UpdateForecasts()
+
+async def UpdCongHistLoop():
+    print('[STARTUP] Running congestion history update loop.')
+    # Carry on from the last slot dealt with, so a slot that ended just before startup
+    # (within HIST_GRACE, which BackfillHistory leaves alone) is still recorded now
+    lastSlot = LastHistSlot()
+    slotTime = NextHistSlot(lastSlot if lastSlot is not None else datetime.now() - timedelta(seconds=HIST_GRACE))
+
+    while True:
+        # Sleep in short steps against the wall clock, so clock changes can't make us drift
+        while (remaining := (slotTime - datetime.now()).total_seconds()) > 0:
+            await asyncio.sleep(min(remaining, 60))
+
+        try:
+            if (datetime.now() - slotTime).total_seconds() > HIST_GRACE:
+                print(f'[UPD_CONG_HIST] Slot {slotTime:%a %H:%M} is too far behind, marking it missed.')
+                await MarkMissedSlots([slotTime])
+            else:
+                await UpdCongHist(slotTime)
+        except Exception as e: # One failed slot shouldn't stop history for good
+            print(f'[UPD_CONG_HIST] Updating slot {slotTime:%a %H:%M} failed: {e}')
+
+        slotTime = NextHistSlot(slotTime)
 
 def ValidatePassword(passwd):
     # 8 characters in length minimum 
@@ -136,77 +1248,325 @@ def ValidatePassword(passwd):
     # passes all cases
     return "valid"
 
-def hash_password(password): #encrypts user's password
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
+async def hash_password(password): #encrypts user's password; None if the auth pool is busy
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    hashed_password = await RunAuth(bcrypt.hashpw, password.encode('utf-8'), salt)
     return hashed_password
 
-def UserAuthenticate(name, passwd):
-    user = USERS_COL.find_one({"name": name}) # Finds a user by their unique username
+async def UserAuthenticate(name, passwd):
+    user = await RunDB(USERS_COL.find_one, {"name": name}) # Finds a user by their unique username
 
     if not user:
         return "null_user"
     
-    if not bcrypt.checkpw(passwd.encode("utf-8"), user['pass']):
+    passMatches = await RunAuth(bcrypt.checkpw, passwd.encode("utf-8"), user['pass'])
+
+    if passMatches is None:
+        return "server_busy"
+
+    if not passMatches:
         return "invalid_pass"
 
     return "valid"
 
 async def CongestionCalc(id):
-    sum = 0
-    lot = SPOTS_COL.find_one({"spaces": {"$elemMatch": {"space_id": id}}})
+    lotIndex = SPOT_LOT[id]
+    free, occupied, reserved = LOT_COUNTS[lotIndex]
+
+    lot_length = free + occupied + reserved # Total parking spaces in lot
+
+    LOT_CONG[lotIndex] = (occupied + reserved) / lot_length # Update congestion field with sum of filled lots by total spaces
+    if IS_LEADER:
+        DIRTY_LOTS.add(lotIndex)
+
+def TransitionSpot(id, status, expected=None, enforceRules=True):
+    # Compare-and-set on one spot: moves it to status if it is currently `expected` (or
+    # anything, if None) and the transition is allowed. The check and the write happen
+    # without yielding to the event loop, so no other update can land in between.
+    # Returns (result, previous status); congestion and subscribers are left to the caller.
+    previous = GetSpotStatus(id)
+
+    if previous is None:
+        return "spot_not_found", None
+    if type(status) is not int or status not in (0, 1, 2): # 1.0 and True compare equal to 1
+        return "invalid_status", previous
+    if expected is not None and previous != expected:
+        return "spot_changed", previous
+    if previous == status:
+        return "spot_unchanged", previous
+
+    # prevent a transition from status 2 (soft reserved) to status 0 (unoccupied), or from occupied to reserved
+    if enforceRules and ((previous == 2 and status == 0) or (previous == 1 and status == 2)):
+        return "spot_update_ignored", previous
 
-    lot_length = len(lot['spaces']) # Total parking spaces in lot
+    SetSpotStatus(id, status)  # set new status; written to the DB by FlushSpotsLoop()
+    return "spot_updated", previous
 
-    for spots in lot['spaces']: # Counts how many lots are occupied at time of call
-        if spots['status'] == 1 or spots['status'] == 2:
-           sum = sum + 1
+def ApplySpotUpdate(id, status):
+    # Applies a reported spot status, ending any reservation the spot was held for
+    result, previous = TransitionSpot(id, status)
+
+    if result == "spot_not_found":
+        print(f"[UPD_SPOT] Spot {id} not found.")
+    elif result == "invalid_status":
+        print(f"[UPD_SPOT] Invalid status for spot {id}: {status}")
+    elif result == "spot_updated" and previous == 2 and status == 1:
+        ReservationTaken(id)
+
+    return result
+
+async def ApplySpotBatch(spots):
+    # Applies [id, status] pairs, then recalculates congestion once per touched lot and
+    # notifies subscribers; returns (result per pair, ids updated, lots touched)
+    results = []
+    updated = []
+    lotSpots = {} # lot index -> one updated spot in it, for the congestion recalculation
+
+    for spot in spots:
+        if not isinstance(spot, list) or len(spot) != 2:
+            results.append("invalid_spot")
+            continue
+
+        id, status = spot
+        result = ApplySpotUpdate(id, status)
+        results.append(result)
+
+        if result == "spot_updated":
+            updated.append(id)
+            lotSpots[SPOT_LOT[id]] = id
+
+    for id in lotSpots.values(): # Congestion only needs recalculating once per lot
+        await CongestionCalc(id)
+
+    for id in updated:
+        NotifySubscribers(id)
+
+    return results, updated, len(lotSpots)
+
+#################################################### Workers and state broker
+
+# With SPOTME_WORKERS > 1 the server runs as that many worker processes, all listening on the
+# same ports (SO_REUSEPORT lets the kernel spread connections across them), started by a
+# supervisor that prepares the DB once (see Supervise()). Each worker keeps a full replica of
+# the in-memory state, so reads are answered locally and scale with the number of cores.
+#
+# Every state change is published as a command to a broker, which delivers each command to
+# every worker in one global order; each worker applies it to its replica with
+# ApplyCommand() and notifies its own subscribers. The worker that published a command gets
+# its result back once its own replica has applied it. Only the leader (worker 0) expires
+# reservations and writes spot state and history to the DB.
+#
+# Brokers:
+#   "local":  applies commands in-process; a single server process (the default)
+#   "socket": relays commands through the supervisor over a Unix socket (BROKER_PATH); for
+#             several workers on one machine
+# A broker for several machines only has to provide the same (connect, publish) pair.
+
+CONNECTIONS = {}                    # id(websocket) -> websocket, for commands naming their connection
+BROKER_WRITER = None                # Socket broker connection, once every worker has joined
+BROKER_TASK = None                  # Task applying the commands the socket broker delivers
+BROKER_WAITING = {}                 # seq -> future for the result of a command this worker published
+BROKER_SEQ = 0                      # Sequence number of this worker's last published command
+
+async def ApplySpotsCommand(command):
+    return await ApplySpotBatch(command["spots"])
+
+async def HoldSpot(command):
+    # Reserves a free spot; the connection that asked for it is only known to its own worker
+    spotId = command["id"]
+    result, previous = TransitionSpot(spotId, 2, expected=0)
+
+    if result == "spot_updated":
+        await CongestionCalc(spotId)
+        NotifySubscribers(spotId)
+
+        websocket = CONNECTIONS.get(command["conn"]) if command["worker"] == WORKER_ID else None
+        AddReservation(spotId, websocket, command["expires"], command["reqId"])
+
+    return result, previous
+
+async def ReleaseCommand(command):
+    return await ReleaseReservations(command["holds"])
+
+async def RevokeSessionsCommand(command):
+    RevokeSessions(command["name"], keep=command["keep"])
+
+async def RenameSessionsCommand(command):
+    RenameSessions(command["name"], command["newName"])
+
+COMMANDS = {
+    # type:                 applied by
+    "spots":                ApplySpotsCommand,
+    "reserve":              HoldSpot,
+    "release":              ReleaseCommand,
+    "revoke_sessions":      RevokeSessionsCommand,
+    "rename_sessions":      RenameSessionsCommand,
+}
+
+async def ApplyCommand(command):
+    # Must not yield between reading and changing state, so commands apply atomically
+    return await COMMANDS[command["type"]](command)
+
+async def PublishLocal(command):
+    return await ApplyCommand(command)
+
+async def ConnectSocketBroker():
+    global BROKER_WRITER, BROKER_TASK
+    reader, writer = await asyncio.open_unix_connection(BROKER_PATH, limit=BROKER_LINE_LIMIT)
+    writer.write(json.dumps({"hello": WORKER_ID}).encode() + b"\n")
+
+    print(f'[BROKER] Worker {WORKER_ID} waiting for the other workers...')
+    await reader.readline() # The hub answers once every worker has joined
+
+    BROKER_WRITER = writer
+    BROKER_TASK = asyncio.create_task(SocketBrokerLoop(reader))
+
+async def SocketBrokerLoop(reader):
+    while line := await reader.readline():
+        command = json.loads(line)
+        waiter = BROKER_WAITING.pop(command["seq"], None) if command["worker"] == WORKER_ID else None
+
+        try:
+            result = await ApplyCommand(command)
+        except Exception as e:
+            print(f'[BROKER] Unexpected error applying {command["type"]}: {e}')
+            if waiter is not None:
+                waiter.set_exception(e)
+            continue
+
+        if waiter is not None:
+            waiter.set_result(result)
+
+    print('[BROKER] Lost the broker connection.')
+
+async def PublishSocket(command):
+    global BROKER_SEQ
+    BROKER_SEQ += 1
+    command["seq"] = BROKER_SEQ
+
+    waiter = asyncio.get_running_loop().create_future()
+    BROKER_WAITING[BROKER_SEQ] = waiter
+    BROKER_WRITER.write(json.dumps(command).encode() + b"\n")
+    return await waiter
+
+BROKERS = {
+    # name:     (connect,               publish)
+    "local":    (None,                  PublishLocal),
+    "socket":   (ConnectSocketBroker,   PublishSocket),
+}
+
+async def Publish(command):
+    # Applies a state change on every worker; returns this worker's result
+    command["worker"] = WORKER_ID
+    return await BROKERS[BROKER][1](command)
+
+async def RunBrokerHub(workers):
+    # The supervisor's end of the "socket" broker: once all workers have joined, every line
+    # one of them sends is relayed to all of them (the sender too), so all see one order.
+    # Returns the listening server and the workers' connections.
+    writers = []
+
+    async def HandleWorker(reader, writer):
+        await reader.readline() # {"hello": worker id}
+        writers.append(writer)
+        if len(writers) == workers:
+            print(f'[BROKER] All {workers} workers joined.')
+            for worker in writers:
+                worker.write(b'{"start": true}\n')
+
+        while line := await reader.readline():
+            for worker in writers: # No await in between, so every worker gets the same order
+                worker.write(line)
+            for worker in writers:
+                await worker.drain()
+
+        print('[BROKER] A worker left the broker.')
+
+    hub = await asyncio.start_unix_server(HandleWorker, BROKER_PATH, limit=BROKER_LINE_LIMIT)
+    return hub, writers
+
+async def Supervise():
+    # Prepares the DB once, then runs WORKERS copies of this script as workers and stops
+    # them all (and itself) as soon as one exits
+    print(f'[STARTUP] Supervising {WORKERS} workers...')
+    LoadLotRegistry()
+    await InitDB()
+    await LoadSpotState()
+    await LoadReservations() # Releases stranded spots, so workers start from the same state
+    await LoadHistory()      # Imports and backfills history
+
+    hub, connections = await RunBrokerHub(WORKERS)
+    env = dict(os.environ, SPOTME_EPOCH=str(int(time.time())))
+    workers = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            env=dict(env, SPOTME_WORKER_ID=str(workerId))
+        )
+        for workerId in range(WORKERS)
+    ]
 
-    SPOTS_COL.update_one({"spaces": {"$elemMatch": {"space_id": id}}}, {"$set": {"congestion_percent": sum / lot_length }}) # Update congestion field with sum of filled lots by total spaces
+    try:
+        await asyncio.wait([asyncio.create_task(worker.wait()) for worker in workers], return_when=asyncio.FIRST_COMPLETED)
+        print('[SHUTDOWN] A worker exited, stopping the rest...')
+    finally:
+        # Workers stop serving once the broker is gone, then flush and exit
+        hub.close()
+        for connection in connections:
+            connection.close()
+        for worker in workers:
+            try:
+                await asyncio.wait_for(worker.wait(), 15)
+            except asyncio.TimeoutError:
+                worker.kill()
 
 #################################################### Server<->Client Functions
 
-async def Login(name, passwd):
+async def Login(name, passwd, websocket):
     print(f"[OPERATION] Login({name})")
 
-    authStatus = UserAuthenticate(name, passwd)
+    authStatus = await UserAuthenticate(name, passwd)
 
     if authStatus != "valid":
         print("[LOGIN] Login failed: " + authStatus)
-        return authStatus, ""
+        return authStatus, "", ""
     
-    userData = json.dumps(USERS_COL.find_one({"name":name}, {"_id": 0,"pass": 0}))
+    userData = json.dumps(await RunDB(USERS_COL.find_one, {"name":name}, {"_id": 0,"pass": 0}))
     print(userData)
 
-    return authStatus, userData
-    
-async def UpdateSpot(id, status): 
-    # print(f"[OPERATION] UpdateSpot({id},{status})")
-    filter = {"spaces.space_id": id}  # find a spot
-    doc = SPOTS_COL.find_one(filter, {"spaces.$": 1})  # retrieve the current spot data
+    return authStatus, userData, IssueSession(websocket, name)
 
-    if doc is None:
-        print(f"[UPD_SPOT] Spot {id} not found.")
-        return "spot_not_found"
+async def Logout(name, websocket, token):
+    print(f"[OPERATION] Logout({name})")
 
-    current_status = doc['spaces'][0]['status']
+    authStatus = CheckSession(websocket, name, token)
 
-    # prevent a transition from status 2 (soft reserved) to status 0 (unoccupied), or from occupied to reserved
-    if (current_status == 2 and status == 0) or (current_status == 1 and status == 2):
-        #print(f"[UPD_SPOT] Attempt to free a soft reserved spot {id} ignored.")
-        return "spot_update_ignored"
+    if authStatus != "valid":
+        print("[LOGOUT] Logout failed: " + authStatus)
+        return authStatus
 
-    update = {"$set": {"spaces.$.status": status}}  # set new status
-    SPOTS_COL.update_one(filter, update)  
+    sessionId = SessionId(token)
+    REVOKED_SESSIONS[sessionId] = SESSIONS.pop(sessionId)["expires"]
+    return "logged_out"
     
-    await CongestionCalc(id)  # update congestion level of lot
+async def UpdateSpot(id, status): 
+    # print(f"[OPERATION] UpdateSpot({id},{status})")
+    # Applied by every worker; ApplySpotBatch() updates congestion and notifies subscribers
+    results, updated, lotCount = await Publish({"type": "spots", "spots": [[id, status]]})
     # print("[UPD_SPOT] Updated spot successfully.")
-    return "spot_updated"
+    return results[0]
+
+async def UpdateSpots(spots):
+    print(f"[OPERATION] UpdateSpots({len(spots)} spots)")
+    results, updated, lotCount = await Publish({"type": "spots", "spots": spots})
+
+    await FlushSpots() # Persist the whole batch in one bulk write (the leader's, on other workers)
+    print(f"[UPD_SPOTS] Updated {len(updated)} of {len(spots)} spots in {lotCount} lots.")
+    return "spots_updated", results
 
 async def CreateAccount(name, passwd): 
     print(f"[OPERATION] CreateAccount({name})")
 
-    if (USERS_COL.find_one({"name": name})): # Only make a new account if the username is unique
+    if (await RunDB(USERS_COL.find_one, {"name": name})): # Only make a new account if the username is unique
         print("[CRTE_ACC] User already exists.")
         return "name_used"
 
@@ -216,7 +1576,11 @@ async def CreateAccount(name, passwd):
         print("[CRTE_ACC] Password requirements not met: " + passwordValidationStatus)
         return passwordValidationStatus
     
-    hashed_password = hash_password(passwd) # Create the hashed password
+    hashed_password = await hash_password(passwd) # Create the hashed password
+
+    if hashed_password is None:
+        print("[CRTE_ACC] Auth pool busy.")
+        return "server_busy"
     
     user = { # Set document
         "name": name,
@@ -224,36 +1588,55 @@ async def CreateAccount(name, passwd):
         "permits": [False, False, False, False, False] # [green,yellow,black,gold,handicap]
     }
 
-    USERS_COL.insert_one(user) # Insert document
+    try:
+        await RunDB(USERS_COL.insert_one, user) # Insert document
+    except pymongo.errors.DuplicateKeyError: # Someone took the name while the password was hashing
+        print("[CRTE_ACC] User already exists.")
+        return "name_used"
     print("[CRTE_ACC] New user created successfully.")
     return "account_created"
 
-async def UpdateName(name, passwd, newName):
+async def UpdateName(name, passwd, newName, websocket=None, token=None):
     print(f"[OPERATION] UpdateName({name},{newName})")
 
-    if (USERS_COL.find_one({"name": newName})): # Ensures new username is unique
+    if (await RunDB(USERS_COL.find_one, {"name": newName})): # Ensures new username is unique
         print("[UPD_NAME] User already exists.")
         return "name_used"
     
-    authStatus = UserAuthenticate(name, passwd)
+    authStatus = await AuthenticateRequest(name, passwd, websocket, token)
 
     if authStatus == "valid":
         filter = {"name": name} # Find document with old name
         update = {"$set": {"name": newName}} # Set new name
-        USERS_COL.update_one(filter, update) # Update document
+        try:
+            await RunDB(USERS_COL.update_one, filter, update) # Update document
+        except pymongo.errors.DuplicateKeyError: # Someone took the name while authenticating
+            print("[UPD_NAME] User already exists.")
+            return "name_used"
+        await Publish({"type": "rename_sessions", "name": name, "newName": newName})
         print("[UPD_NAME] New username is set!")
         return "updated_name"
     else:
         print("[UPD_NAME] Authentication failed: " + authStatus)
         return authStatus
 
-async def UpdatePass(name, passwd, newPass):
+async def UpdatePass(name, passwd, newPass, websocket=None, token=None):
     print(f"[OPERATION] UpdatePass({name})")
     
-    authStatus = UserAuthenticate(name, passwd) # Check user's name and password
+    authStatus = await AuthenticateRequest(name, passwd, websocket, token) # Check user's name and password (or session)
 
     if authStatus == "valid":
-        if passwd == newPass: # Make sure the new password is not the same as the old password
+        if token is None:
+            samePass = passwd == newPass
+        else: # No old password to compare with, so check the new one against the stored hash
+            user = await RunDB(USERS_COL.find_one, {"name": name})
+            samePass = await RunAuth(bcrypt.checkpw, newPass.encode("utf-8"), user['pass']) if user else False
+
+            if samePass is None:
+                print("[UPD_PASS] Auth pool busy.")
+                return "server_busy"
+
+        if samePass: # Make sure the new password is not the same as the old password
             print("[UPD_PASS] new password is the same as the old one.")
             return "same_pass"
 
@@ -263,10 +1646,16 @@ async def UpdatePass(name, passwd, newPass):
             print("[UPD_PASS] Password requirements not met: " + passwordValidationStatus)
             return passwordValidationStatus
 
-        hashed_password = hash_password(newPass) # Hash new password
+        hashed_password = await hash_password(newPass) # Hash new password
+
+        if hashed_password is None:
+            print("[UPD_PASS] Auth pool busy.")
+            return "server_busy"
+
         filter = {"name": name} # Find document
         update = {"$set": {"pass": hashed_password}} # Set new password
-        USERS_COL.update_one(filter, update) # Push update to that document
+        await RunDB(USERS_COL.update_one, filter, update) # Push update to that document
+        await Publish({"type": "revoke_sessions", "name": name, "keep": SessionId(token)}) # Log out everywhere else
         print("[UPD_PASS] New password set!")
         return "pass_updated"
 
@@ -276,20 +1665,20 @@ async def UpdatePass(name, passwd, newPass):
         
 async def RefreshData():
     print('[OPERATION] RefreshData()')
-    try:
-        data = list(SPOTS_COL.find({}, {'_id': False, 'histData' : False})) # Updated parking spot/lot information (congestion, occupancy);
-        print(f'[REFR_DATA] Retrieved {len(data)} records from the DB.')
-        return "data_retrieved", json.dumps(data)
-    
-    except Exception as e:
-        print('[REFR_DATA]: {e}')
-        return "data_error", ""
+    return RefreshPayload() # Whole reply, already encoded; see RefreshData cache
     
-async def UpdatePermits(name, passwd, newPermits):                        
+async def UpdatePermits(name, passwd, newPermits, websocket=None, token=None):
     print(f'[OPERATION] UpdatePermits({name},{newPermits})')
     # [green,yellow,black,gold,handicap]
 
-    # authStatus = UserAuthenticate(name, passwd)                            ## FIXME: Uncomment when passwd passthrough is enabled clientside!
+    if token is not None: # Clients with a session are checked; the rest wait on the FIXME below
+        authStatus = CheckSession(websocket, name, token)
+
+        if authStatus != "valid":
+            print("[UPD_PERM] Authentication failed: " + authStatus)
+            return authStatus
+
+    # authStatus = await UserAuthenticate(name, passwd)                            ## FIXME: Uncomment when passwd passthrough is enabled clientside!
 
     # if authStatus != "valid":
     #    print("[UPD_PERM] Authentication failed: " + authStatus)
@@ -298,7 +1687,7 @@ async def UpdatePermits(name, passwd, newPermits):
     filter = {"name": name}
     update = {"$set": {"permits": newPermits}}
         
-    result = USERS_COL.update_one(filter, update)
+    result = await RunDB(USERS_COL.update_one, filter, update)
         
     if result.modified_count > 0:
         print("[UPD_PERM] Permits updated successfully!")
@@ -307,24 +1696,32 @@ async def UpdatePermits(name, passwd, newPermits):
         print("[UPD_PERM] Permits not updated.")
         return "permits_unchanged"
 
-async def DeleteAccount(name, passwd):                      
+async def DeleteAccount(name, passwd, websocket=None, token=None):
     print(f'[OPERATION] DeleteAccount({name})')
     
-    authStatus = UserAuthenticate(name, passwd)
+    authStatus = await AuthenticateRequest(name, passwd, websocket, token)
 
     if authStatus == "valid":
         filter = {"name": name}
-        result = await USERS_COL.delete_one(filter)
+        result = await RunDB(USERS_COL.delete_one, filter)
+        await Publish({"type": "revoke_sessions", "name": name, "keep": None})
         print(f"[DEL_ACC] Account deleted successfully.")
         return "account_deleted"
     else:
         print("[DEL_ACC] Failed authentication: " + authStatus)
         return authStatus
     
-async def SaveWeeklySchedule(name, passwd, newSched):
+async def SaveWeeklySchedule(name, passwd, newSched, websocket=None, token=None):
     print(f'[OPERATION] SaveWeeklySchedule({name})')
 
-    # authStatus = UserAuthenticate(name, passwd)                   ## FIXME: Uncomment when passwd passthrough is enabled clientside!
+    if token is not None: # Clients with a session are checked; the rest wait on the FIXME below
+        authStatus = CheckSession(websocket, name, token)
+
+        if authStatus != "valid":
+            print("[UPD_PERM] Authentication failed: " + authStatus)
+            return authStatus
+
+    # authStatus = await UserAuthenticate(name, passwd)                   ## FIXME: Uncomment when passwd passthrough is enabled clientside!
 
     # if authStatus != "valid":                                                 
     #    print("[UPD_PERM] Authentication failed: " + authStatus)
@@ -334,7 +1731,7 @@ async def SaveWeeklySchedule(name, passwd, newSched):
 
     update = {"$set": {"weeklySchedule": newSched}}
 
-    result = USERS_COL.update_one(filter, update)
+    result = await RunDB(USERS_COL.update_one, filter, update)
 
     if result.modified_count > 0:
         print("[UPD_PERM] Schedule updated successfully!")
@@ -345,15 +1742,11 @@ async def SaveWeeklySchedule(name, passwd, newSched):
     
 async def QuerySpot(spot_id):
     #print(f'[OPERATION] QuerySpot({spot_id})')
-    lot = SPOTS_COL.find_one({"spaces.space_id": spot_id}, {"_id": 0, "spaces.$": 1})
-    if lot is None:
+    status = GetSpotStatus(spot_id)
+    if status is None:
         print(f'[REFR_SPOT_DATA] Spot not found in the database: {spot_id}')
         return "null"
 
-    spot_data = lot['spaces'][0]
-    #print(f'[REFR_SPOT_DATA] Successfully retrieved data for spot {spot_id}.')
-    status = spot_data["status"]
-
     if status == 0:
         return "unoccupied"
     elif status == 1:
@@ -364,7 +1757,123 @@ async def QuerySpot(spot_id):
         print(f"[REFER_SPOT_DATA] Unknown/invalid spot status? ({status})")
         return "invalid"
 
-async def ReserveSpot(spotId, websocket):
+async def Subscribe(websocket, lots):
+    print(f'[OPERATION] Subscribe({lots})')
+
+    if lots is None: # No filter means every lot
+        lotIndices = range(len(LOT_IDS))
+    else:
+        unknownLots = [lot for lot in lots if lot not in LOT_INDEX]
+        if unknownLots:
+            print(f'[SUBSCRIBE] Unknown lots requested: {unknownLots}')
+            return "lot_not_found", None, []
+        lotIndices = [LOT_INDEX[lot] for lot in lots]
+
+    AddSubscriber(websocket, lotIndices)
+    # The snapshot's version lets the client ask Snapshot for what it missed if deltas get dropped
+    return "subscribed", STATE_VERSION, [LotSnapshot(lotIndex) for lotIndex in lotIndices]
+
+async def Unsubscribe(websocket):
+    print('[OPERATION] Unsubscribe()')
+    RemoveSubscriber(websocket)
+    return "unsubscribed"
+
+async def Snapshot(since):
+    print(f'[OPERATION] Snapshot({since})')
+
+    changed = ChangedSince(since) if isinstance(since, int) else None
+
+    if changed is None or len(changed) > MAX_DIFF_SPOTS:
+        return "snapshot", STATE_VERSION, [EncodeLot(lotIndex) for lotIndex in range(len(LOT_IDS))]
+
+    changedLots = sorted({SPOT_LOT[id] for id in changed})
+    return "diff", STATE_VERSION, {
+        "spaces": [[id, SPOT_STATUS[id]] for id in sorted(changed)],
+        "lots": [{"lot_id": LOT_IDS[lotIndex], "congestion_percent": LOT_CONG[lotIndex]} for lotIndex in changedLots]
+    }
+
+async def PredictCongestion(lots, slots):
+    print(f'[OPERATION] PredictCongestion({lots},{slots})')
+
+    if lots is None and slots is None:
+        return FORECAST_PAYLOAD # Whole reply, already encoded
+
+    if lots is not None and any(lot not in FORECASTS for lot in lots):
+        return {"status": "lot_not_found"}
+
+    slots = FORECAST_SLOTS if slots is None else slots
+    data = {lot: FORECASTS[lot][:slots] for lot in (FORECASTS if lots is None else lots)}
+    return {"status": "forecast_ready", "generated": FORECAST_TIME, "data": data}
+
+async def ListLots():
+    print('[OPERATION] ListLots()')
+    lots = [
+        {"lot_id": lotId, "name": lot["name"], "marker": lot["marker"], "capacity": len(lot["spaces"])}
+        for lotId, lot in LOT_REGISTRY.items()
+    ]
+    return "lots_retrieved", lots
+
+async def FindNearestFree(latitude, longitude, k, permit):
+    print(f'[OPERATION] FindNearestFree({latitude},{longitude},{k},{permit})')
+
+    for value, limit in ((latitude, 90), (longitude, 180)):
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not abs(value) <= limit: # Also rules out NaN
+            return "invalid_coordinates", []
+
+    if not isinstance(k, int) or k < 1 or k > MAX_NEAREST:
+        return "invalid_count", []
+
+    if permit is not None and permit not in PERMITS:
+        return "invalid_permit", []
+
+    def IsFreeAndAllowed(id):
+        if GetSpotStatus(id) != 0:
+            return False
+        return permit is None or SPOT_PERMIT[id] == PERMITS.index(permit)
+
+    spots = [
+        {
+            "space_id": id,
+            "lot_id": LOT_IDS[SPOT_LOT[id]],
+            "latitude": round(SPOT_LATLON[id][0], 7),
+            "longitude": round(SPOT_LATLON[id][1], 7),
+            "distance_m": round(distance, 1)
+        }
+        for distance, id in NearestSpots(latitude, longitude, k, IsFreeAndAllowed)
+    ]
+    return "spots_found" if spots else "no_free_spots", spots
+
+async def Availability(permits):
+    # permits is either a user's [green,yellow,black,gold,handicap] flags or a list of permit names
+    print(f'[OPERATION] Availability({permits})')
+
+    if not isinstance(permits, list):
+        return "invalid_permits", {}
+
+    if len(permits) == len(PERMITS) and all(isinstance(flag, bool) for flag in permits):
+        permitIndices = [index for index, held in enumerate(permits) if held]
+    elif all(permit in PERMITS for permit in permits):
+        permitIndices = sorted(set(PERMITS.index(permit) for permit in permits))
+    else:
+        return "invalid_permits", {}
+
+    availability = {}
+    for lotIndex, lotId in enumerate(LOT_IDS):
+        permitCounts = LOT_PERMIT_COUNTS[lotIndex]
+        lotAvailability = {"free": 0, "occupied": 0, "reserved": 0, "permits": {}}
+
+        for index in permitIndices:
+            free, occupied, reserved = permitCounts[index]
+            lotAvailability["permits"][PERMITS[index]] = {"free": free, "occupied": occupied, "reserved": reserved}
+            lotAvailability["free"] += free
+            lotAvailability["occupied"] += occupied
+            lotAvailability["reserved"] += reserved
+
+        availability[lotId] = lotAvailability
+
+    return "availability_retrieved", availability
+
+async def ReserveSpot(spotId, websocket, reqId=None):
     print(f'[OPERATION] ReserveSpot({spotId})')
 
     # Client side:
@@ -373,268 +1882,701 @@ async def ReserveSpot(spotId, websocket):
     # If client receives "time_limit_reached" status, end reservation and cancel timer
     # If timer reaches 0, assume that connection to server has been lost and cancel reservation.
 
-    spot = await QuerySpot(spotId)
+    # Only a free spot can be held; checking and reserving it is one step (see HoldSpot())
+    expires = time.time() + RESERVATION_TIME
+    result, previous = await Publish({"type": "reserve", "id": spotId, "expires": expires, "conn": id(websocket), "reqId": reqId})
 
-    if spot == "occupied":
+    if result == "spot_not_found":
+        status = "spot_not_found"
+        await SendReservationStatus(websocket, spotId, status, reqId)
+        return
+    if previous == 1:
         print("[RESERVE_SPOT] Spot was already occupied!")
         status = "preoccupied"
-        await websocket.send(json.dumps({"op": "ReserveSpot", "id": spotId, "status":status}))
+        await SendReservationStatus(websocket, spotId, status, reqId)
         return
-    if spot == "reserved":
+    if previous == 2:
         print("[RESERVE_SPOT] Spot was pre-reserved!")
         status = "prereserved"
-        await websocket.send(json.dumps({"op": "ReserveSpot", "id": spotId, "status":status}))
+        await SendReservationStatus(websocket, spotId, status, reqId)
         return
+
+    # The reservation manager sends "taken" or "time_limit_reached" when the hold ends
+    await RunDB(RESV_COL.replace_one, {"space_id": spotId}, {"space_id": spotId, "expires": expires}, upsert=True)
     
-    await UpdateSpot(spotId, 2)
+#################################################### Operation metrics
 
-    for i in range(0,15):
-        #print("[RESERVE_SPOT] Requerying...")
-        spot = await QuerySpot(spotId)
+# Every operation's call count, error count and latency are recorded by HandleOperation().
+# Clients can read them with the Stats operation, and a plain-text version is served over
+# HTTP on METRICS_PORT (on WORKER_METRICS_PORT + n for worker n when there are several).
 
-        if spot == "occupied":
-            print("[RESERVE_SPOT] Spot was taken mid-reservation!")
-            status = "taken"
-            await websocket.send(json.dumps({"op": "ReserveSpot", "id": spotId, "status":status}))
-            return
-    
-        await asyncio.sleep(1)
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000] # ms
+
+OP_STATS = {}                       # op -> {"count", "errors", "buckets", "recent"}
+
+def RecordOp(op, elapsedMs, failed):
+    stats = OP_STATS.get(op)
+    if stats is None:
+        stats = OP_STATS[op] = {
+            "count": 0,
+            "errors": 0,
+            "buckets": [0] * (len(LATENCY_BUCKETS) + 1), # Last bucket is "slower than all of them"
+            "recent": deque(maxlen=LATENCY_SAMPLES)
+        }
+
+    stats["count"] += 1
+    stats["errors"] += 1 if failed else 0
+    stats["buckets"][bisect.bisect_left(LATENCY_BUCKETS, elapsedMs)] += 1
+    stats["recent"].append(elapsedMs)
+
+def Percentile(sortedSamples, fraction):
+    if not sortedSamples:
+        return 0
+    return sortedSamples[min(len(sortedSamples) - 1, int(fraction * len(sortedSamples)))]
+
+def OpSummary(stats):
+    recent = sorted(stats["recent"])
+    return {
+        "count": stats["count"],
+        "errors": stats["errors"],
+        "p50_ms": round(Percentile(recent, 0.50), 3),
+        "p95_ms": round(Percentile(recent, 0.95), 3),
+        "p99_ms": round(Percentile(recent, 0.99), 3)
+    }
+
+def MetricsText():
+    lines = []
+    for op, stats in sorted(OP_STATS.items()):
+        summary = OpSummary(stats)
+        lines.append(f'spotme_op_count{{op="{op}"}} {summary["count"]}')
+        lines.append(f'spotme_op_errors{{op="{op}"}} {summary["errors"]}')
+
+        for quantile in ("p50", "p95", "p99"):
+            lines.append(f'spotme_op_latency_ms{{op="{op}",quantile="{quantile}"}} {summary[quantile + "_ms"]}')
+
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], stats["buckets"]):
+            cumulative += count
+            lines.append(f'spotme_op_latency_ms_bucket{{op="{op}",le="{bound}"}} {cumulative}')
+
+    for key, value in ConnectionStats().items():
+        lines.append(f'spotme_connections_{key} {value}')
+
+    return "\n".join(lines) + "\n"
+
+async def HandleMetricsRequest(reader, writer):
+    # Minimal HTTP responder: every request gets the metrics text
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = MetricsText().encode('utf-8')
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; charset=utf-8\r\n" +
+            f"Content-Length: {len(body)}\r\n".encode('ascii') +
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def Stats():
+    print('[OPERATION] Stats()')
+    return "stats_retrieved", {op: OpSummary(stats) for op, stats in sorted(OP_STATS.items())}
+
+#################################################### Connection limits and outbound queues
+
+# Nothing is sent to a phone straight from the code that produced it. Send() queues the
+# message on the connection's outbox and SendLoop() writes it out, so a client that reads
+# slowly only ever holds up itself. A full outbox applies SEND_POLICIES: a SpotDelta push is
+# dropped (the client gets a "Resync" message once it has caught up and should call
+# Snapshot with the last version it saw), and a reply closes the connection. Pushes count as
+# full at SEND_PUSH_LIMIT, so a burst of deltas can't leave the client's next reply no room.
+#
+# Each connection also has a token bucket per op class (RATE_LIMITS); an operation over its
+# class's rate gets "rate_limited" with the seconds until it may be retried. Connections
+# past MAX_CONNECTIONS (or MAX_GATEWAY_CONNECTIONS) are closed with code 1013 "server_full".
+
+OUTBOXES = {}                       # websocket -> {"queue", "wakeup", "dropped"}, for open phone connections
+GATEWAY_CONNECTIONS = 0             # Open connections on INGEST_PORT
+CONNECTION_STATS = {"rejected": 0, "rate_limited": 0, "dropped": 0, "slow_closed": 0}
+
+def Send(websocket, message, kind="reply"):
+    # Queues an encoded message; returns False if it was dropped instead
+    outbox = OUTBOXES.get(websocket)
+    if outbox is None: # Connection closed (or closing)
+        return False
+
+    if len(outbox["queue"]) >= (SEND_PUSH_LIMIT if kind == "push" else SEND_QUEUE_LIMIT):
+        if SEND_POLICIES[kind] == "drop":
+            CONNECTION_STATS["dropped"] += 1
+            outbox["dropped"] = True
+            return False
+
+        print(f"[SEND] {websocket.remote_address} isn't reading its replies, closing it.")
+        CONNECTION_STATS["slow_closed"] += 1
+        del OUTBOXES[websocket]
+        asyncio.create_task(websocket.close(1008, "slow_consumer"))
+        return False
+
+    outbox["queue"].append(message)
+    outbox["wakeup"].set()
+    return True
+
+async def SendLoop(websocket, outbox):
+    queue = outbox["queue"]
+    try:
+        while True:
+            await outbox["wakeup"].wait()
+            outbox["wakeup"].clear()
+
+            while queue:
+                await websocket.send(queue.popleft())
+
+                if outbox["dropped"] and not queue: # Caught up after losing pushes
+                    outbox["dropped"] = False
+                    queue.append(json.dumps({"op": "Resync", "status": "deltas_dropped"}))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+def TakeToken(buckets, opClass):
+    # Spends one of the connection's tokens for this op class; returns 0 if there was one,
+    # otherwise the seconds until there will be
+    rate, burst = RATE_LIMITS[opClass]
+    now = time.monotonic()
+    tokens, last = buckets.get(opClass, (burst, now))
+    tokens = min(burst, tokens + (now - last) * rate)
+
+    if tokens < 1:
+        buckets[opClass] = (tokens, now)
+        return (1 - tokens) / rate
+
+    buckets[opClass] = (tokens - 1, now)
+    return 0
+
+def ConnectionStats():
+    return {"open": len(OUTBOXES), "gateways": GATEWAY_CONNECTIONS, **CONNECTION_STATS}
 
-    spot = await QuerySpot(spotId)
-    
-    if spot != "occupied":
-        await UpdateSpot(spotId, 1)
-        await UpdateSpot(spotId, 0)
-    
-    print("[RESERVE_SPOT] Time limit reached!")
-    status = "time_limit_reached"
-    await websocket.send(json.dumps({"op": "ReserveSpot", "id": spotId, "status":status}))
-    return
-    
 #################################################### Websocket message handling; calls appropriate functions from JSON encoded messages
 
-async def HandleOperation(websocket, rcvdJson):
+# Each handler takes the decoded message and returns the reply to send (or None if the
+# operation replies later on its own). A reply is normally a dict, but may also be a
+# complete message that is already encoded. OPERATIONS maps op names to a handler and the fields
+# the message must carry; HandleOperation() checks those before calling the handler.
+#
+# A connection may have up to MAX_OPS_PER_CONNECTION operations running at once, so replies
+# can come back in a different order than the requests. Clients that pipeline should send a
+# "reqId" with each message; it is echoed back in the matching reply.
+
+async def HandleLogin(websocket, rcvdJson):
+    status, userData, token = await Login(rcvdJson["name"], rcvdJson["passwd"], websocket)
+    return {"status": status, "userData": userData, "token": token}
+
+async def HandleLogout(websocket, rcvdJson):
+    status = await Logout(rcvdJson["name"], websocket, rcvdJson["token"])
+    return {"status": status}
+
+async def HandleUpdateSpot(websocket, rcvdJson):
+    status = await UpdateSpot(rcvdJson["id"], rcvdJson["status"])
+    return {"status": status}
+
+async def HandleUpdateSpots(websocket, rcvdJson):
+    if not isinstance(rcvdJson["spots"], list):
+        return {"status": "invalid_spots"}
+
+    status, results = await UpdateSpots(rcvdJson["spots"]) # List of [id, status] pairs
+    return {"status": status, "results": results}
+
+async def HandleCreateAccount(websocket, rcvdJson):
+    status = await CreateAccount(rcvdJson["name"], rcvdJson["passwd"])
+    return {"status": status}
+
+async def HandleUpdateName(websocket, rcvdJson):
+    # "token" is the session token from Login and replaces "passwd"
+    status = await UpdateName(rcvdJson["name"], rcvdJson.get("passwd"), rcvdJson["newName"], websocket, rcvdJson.get("token"))
+    return {"status": status}
+
+async def HandleUpdatePass(websocket, rcvdJson):
+    status = await UpdatePass(rcvdJson["name"], rcvdJson.get("passwd"), rcvdJson["newPass"], websocket, rcvdJson.get("token"))
+    return {"status": status}
+
+async def HandleRefreshData(websocket, rcvdJson):
+    return await RefreshData()
+
+async def HandleUpdatePermits(websocket, rcvdJson):
+    passwd = "PLACEHOLDER" # rcvdJson["passwd"]                     ## FIXME
+    status = await UpdatePermits(rcvdJson["name"], passwd, rcvdJson["permits"], websocket, rcvdJson.get("token"))
+    return {"status": status}
+
+async def HandleDeleteAccount(websocket, rcvdJson):
+    status = await DeleteAccount(rcvdJson["name"], rcvdJson.get("passwd"), websocket, rcvdJson.get("token"))
+    return {"status": status}
+
+async def HandleSaveWeeklySchedule(websocket, rcvdJson):
+    passwd = "PLACEHOLDER" # rcvdJson["passwd"]                     ##
+    status = await SaveWeeklySchedule(rcvdJson["name"], passwd, rcvdJson["newSched"], websocket, rcvdJson.get("token"))
+    return {"status": status}
+
+async def HandleQuerySpot(websocket, rcvdJson):
+    status = await QuerySpot(rcvdJson["id"])
+    return {"status": status}
+
+async def HandleReserveSpot(websocket, rcvdJson):
+    await ReserveSpot(rcvdJson["id"], websocket, rcvdJson.get("reqId")) # Replies by itself when the reservation ends
+    return None
+
+async def HandleSubscribe(websocket, rcvdJson):
+    status, version, data = await Subscribe(websocket, rcvdJson.get("lots")) # Optional list of lot_ids, defaults to all lots
+    return {"status": status, "version": version, "data": data}
+
+async def HandleSnapshot(websocket, rcvdJson):
+    status, version, data = await Snapshot(rcvdJson.get("since")) # Optional version of the client's last snapshot
+    return {"status": status, "version": version, "data": data}
+
+async def HandleUnsubscribe(websocket, rcvdJson):
+    status = await Unsubscribe(websocket)
+    return {"status": status}
+
+async def HandlePredictCongestion(websocket, rcvdJson):
+    # Optional "lots" (list of lot_ids) and "slots" (how many upcoming slots) narrow the reply
+    lots, slots = rcvdJson.get("lots"), rcvdJson.get("slots")
+
+    if lots is not None and (not isinstance(lots, list) or not all(isinstance(lot, str) for lot in lots)):
+        return {"status": "invalid_lots"}
+    if slots is not None and (not isinstance(slots, int) or isinstance(slots, bool) or slots < 1):
+        return {"status": "invalid_slots"}
+
+    return await PredictCongestion(lots, slots)
+
+async def HandleFindNearestFree(websocket, rcvdJson):
+    # "k" defaults to 1; "permit" (e.g. "green") limits results to spots of that class
+    status, spots = await FindNearestFree(rcvdJson["lat"], rcvdJson["lon"], rcvdJson.get("k", 1), rcvdJson.get("permit"))
+    return {"status": status, "spots": spots}
+
+async def HandleAvailability(websocket, rcvdJson):
+    status, availability = await Availability(rcvdJson["permits"])
+    return {"status": status, "availability": availability}
+
+async def HandleListLots(websocket, rcvdJson):
+    status, lots = await ListLots()
+    return {"status": status, "lots": lots}
+
+async def HandleStats(websocket, rcvdJson):
+    status, stats = await Stats()
+    return {"status": status, "stats": stats, "ingest": INGEST_STATS, "connections": ConnectionStats(), "worker": WORKER_ID}
+
+OPERATIONS = {
+    # op:                   (handler,                   required fields,             rate class)
+    "Login":                (HandleLogin,               ("name", "passwd"),          "auth"),
+    "Logout":               (HandleLogout,              ("name", "token"),           "auth"),
+    "UpdateSpot":           (HandleUpdateSpot,          ("id", "status"),            "update"),
+    "UpdateSpots":          (HandleUpdateSpots,         ("spots",),                  "update"),
+    "CreateAccount":        (HandleCreateAccount,       ("name", "passwd"),          "auth"),
+    "UpdateName":           (HandleUpdateName,          ("name", "newName"),         "auth"),
+    "UpdatePass":           (HandleUpdatePass,          ("name", "newPass"),         "auth"),
+    "RefreshData":          (HandleRefreshData,         (),                          "refresh"),
+    "UpdatePermits":        (HandleUpdatePermits,       ("name", "permits"),         "auth"),
+    "DeleteAccount":        (HandleDeleteAccount,       ("name",),                   "auth"),
+    "SaveWeeklySchedule":   (HandleSaveWeeklySchedule,  ("name", "newSched"),        "auth"),
+    "QuerySpot":            (HandleQuerySpot,           ("id",),                     "read"),
+    "ReserveSpot":          (HandleReserveSpot,         ("id",),                     "reserve"),
+    "Subscribe":            (HandleSubscribe,           (),                          "refresh"),
+    "Snapshot":             (HandleSnapshot,            (),                          "read"),
+    "Unsubscribe":          (HandleUnsubscribe,         (),                          "read"),
+    "PredictCongestion":    (HandlePredictCongestion,   (),                          "read"),
+    "ListLots":             (HandleListLots,            (),                          "read"),
+    "FindNearestFree":      (HandleFindNearestFree,     ("lat", "lon"),              "read"),
+    "Availability":         (HandleAvailability,        ("permits",),                "read"),
+    "Stats":                (HandleStats,               (),                          "read"),
+}
+
+def Envelope(rcvdJson, reply):
+    # Echoes the request's reqId (if it had one) in the reply and encodes it
+    if isinstance(reply, str): # Already encoded, so splice the reqId in before the final brace
+        if "reqId" in rcvdJson:
+            reply = reply[:-1] + ', "reqId": ' + json.dumps(rcvdJson["reqId"]) + "}"
+        return reply
+
+    if "reqId" in rcvdJson:
+        reply["reqId"] = rcvdJson["reqId"]
+    return json.dumps(reply)
+
+async def HandleOperation(websocket, rcvdJson, buckets):
+    op = rcvdJson.get("op")
+    operation = OPERATIONS.get(op)
+
+    retryAfter = TakeToken(buckets, operation[2] if operation else "read")
+    if retryAfter:
+        CONNECTION_STATS["rate_limited"] += 1
+        Send(websocket, Envelope(rcvdJson, {"op": op, "status": "rate_limited", "retryAfter": round(retryAfter, 2)}))
+        return
+
+    if operation is None:
+        print(f'[HANDLE_OP] ERROR: Unrecognized operation received: {op}')
+        Send(websocket, Envelope(rcvdJson, {"status": "unrecognized_operation"}))
+        return
+
+    handler, requiredFields, _ = operation
+    missingFields = [field for field in requiredFields if field not in rcvdJson]
+
+    if missingFields:
+        print(f'[HANDLE_OP] {op} is missing fields: {missingFields}')
+        RecordOp(op, 0, True)
+        Send(websocket, Envelope(rcvdJson, {"op": op, "status": "missing_fields", "fields": missingFields}))
+        return
+
+    startTime = time.perf_counter()
+    failed = False
+
     try:
-        if rcvdJson["op"] == "Login":
-            print("[HANDLE_OP] Handling LOGIN.")
-            op = rcvdJson["op"]
-            name = rcvdJson["name"]
-            passwd = rcvdJson["passwd"]
-            status, userData = await Login(name, passwd)
-            await websocket.send(json.dumps({"op": op, "status": status, "userData":userData}))
-
-        elif rcvdJson["op"] == "UpdateSpot":
-            op = rcvdJson["op"]
-            id = rcvdJson["id"]
-            status = rcvdJson["status"]
-            status = await UpdateSpot(id, status)
-            await websocket.send(json.dumps({"op":op,"status": status}))
-
-        elif rcvdJson["op"] == "CreateAccount":
-            print("[HANDLE_OP] Handling CREATE_ACCOUNT.")
-            op = rcvdJson["op"]
-            name = rcvdJson["name"]
-            passwd = rcvdJson["passwd"]
-            status = await CreateAccount(name, passwd)
-            await websocket.send(json.dumps({"op": op, "status": status}))
-
-        elif rcvdJson["op"] == "UpdateName":
-            print("[HANDLE_OP] Handling UPDATE_NAME.")
-            op = rcvdJson["op"]
-            name = rcvdJson["name"]
-            passwd = rcvdJson["passwd"]
-            newName = rcvdJson["newName"]
-            status = await UpdateName(name, passwd, newName)
-            await websocket.send(json.dumps({"op":op, "status": status}))
-            
-        elif rcvdJson["op"] == "UpdatePass":
-            print("[HANDLE_OP] Handling UPDATE_PASS.")
-            op = rcvdJson["op"]
-            name = rcvdJson["name"]
-            passwd = rcvdJson["passwd"]
-            newPass = rcvdJson["newPass"]
-            status = await UpdatePass(name, passwd, newPass)
-            await websocket.send(json.dumps({"op":op, "status": status}))
-
-        elif rcvdJson["op"] == "RefreshData":
-            print("[HANDLE_OP] Handling REFRESH_DATA.")
-            op = rcvdJson["op"]
-            status, data = await RefreshData()
-            await websocket.send(json.dumps({"op": op, "status":status, "data": data}))
-
-        elif rcvdJson["op"] == "UpdatePermits":
-            print("[HANDLE_OP] Handling UPDATE_PERMITS.")
-            op = rcvdJson["op"]
-            name = rcvdJson["name"]
-            passwd = "PLACEHOLDER" # rcvdJson["passwd"]                     ## FIXME
-            newPermits = rcvdJson["permits"]
-            status = await UpdatePermits(name,passwd,newPermits)
-            await websocket.send(json.dumps({"op": op, "status":status}))
-
-        elif rcvdJson["op"] == "DeleteAccount":
-            print("[HANDLE_OP] Handling DELETE_ACCOUNT.")
-            op = rcvdJson["op"]
-            name = rcvdJson["name"]
-            passwd = rcvdJson["passwd"]
-            status = await DeleteAccount(name,passwd)
-            await websocket.send(json.dumps({"op": op, "status": status}))
-
-        elif rcvdJson["op"] == "SaveWeeklySchedule":
-            print("[HANDLE_OP] Handling SAVE_WEEKLY_SCHEDULE.")
-            op = rcvdJson["op"]
-            name = rcvdJson["name"]
-            passwd = "PLACEHOLDER" # rcvdJson["passwd"]                     ##
-            newSched = rcvdJson["newSched"]
-            status = await SaveWeeklySchedule(name,passwd,newSched)
-            await websocket.send(json.dumps({"op": op, "status": status}))
-
-        elif rcvdJson["op"] == "QuerySpot":
-            print("[HANDLE_OP] Handling QUERY_SPOT")
-            op = rcvdJson["op"]
-            id = rcvdJson["id"]
-            status = await QuerySpot(id)
-            await websocket.send(json.dumps({"op": op, "status": status}))
-
-        elif rcvdJson["op"] == "ReserveSpot":
-            print("[HANDLE_OP] Handling RESERVE_SPOT")
-            id = rcvdJson["id"]
-            asyncio.create_task(ReserveSpot(id, websocket))
-
-        else:
-            print(f'[HANDLE_OP] ERROR: Unrecognized operation received: {rcvdJson["op"]}')
-            status = "unrecognized_operation"
-            await websocket.send(json.dumps({"status": status}))
-            
-    except websockets.exceptions.ConnectionClosedError:
-        print("[HANDLE_OP] Connection closed while handling operation.")
-    except websockets.exceptions.ConnectionClosedOK:
-        print("[HANDLE_OP] Connection closed with OK status.")
+        reply = await handler(websocket, rcvdJson)
+
+        if reply is not None:
+            Send(websocket, Envelope(rcvdJson, reply if isinstance(reply, str) else {"op": op, **reply}))
+
     except Exception as e:
+        failed = True
         print(f"[HANDLE_OP] Unexpected error: {e}. Received JSON: {json.dumps(rcvdJson)}")
+        Send(websocket, Envelope(rcvdJson, {"op": op, "status": "server_error"})) # Don't leave the client waiting
+    finally:
+        RecordOp(op, (time.perf_counter() - startTime) * 1000, failed)
 
 async def HandleMsg(websocket):
-    async for msg in websocket:
-        if msg == DISCONNECT_MESSAGE:
-            return
-        
-        rcvdJson = json.loads(msg)
-        await HandleOperation(websocket, rcvdJson)
+    if len(OUTBOXES) >= MAX_CONNECTIONS:
+        print(f'[HANDLE_MSG] At {MAX_CONNECTIONS} connections, turning {websocket.remote_address} away.')
+        CONNECTION_STATS["rejected"] += 1
+        await websocket.close(1013, "server_full")
+        return
+
+    inFlight = asyncio.Semaphore(MAX_OPS_PER_CONNECTION)
+    tasks = set()
+    buckets = {} # op class -> (tokens, time.monotonic() they were counted)
+    outbox = OUTBOXES[websocket] = {"queue": deque(), "wakeup": asyncio.Event(), "dropped": False}
+    sender = asyncio.create_task(SendLoop(websocket, outbox))
+    CONNECTIONS[id(websocket)] = websocket
+
+    async def RunOperation(rcvdJson):
+        try:
+            await HandleOperation(websocket, rcvdJson, buckets)
+        finally:
+            inFlight.release()
+
+    try:
+        async for msg in websocket:
+            if msg == DISCONNECT_MESSAGE:
+                return
+            
+            try:
+                rcvdJson = json.loads(msg)
+            except ValueError:
+                rcvdJson = None
+
+            if not isinstance(rcvdJson, dict): # Not JSON, or JSON that isn't an object
+                print(f'[HANDLE_MSG] Invalid message from {websocket.remote_address}, ignoring it.')
+                Send(websocket, json.dumps({"status": "invalid_message"}))
+                continue
+
+            await inFlight.acquire() # Stop reading while the connection is at its limit
+            task = asyncio.create_task(RunOperation(rcvdJson))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            await asyncio.wait(tasks)
+        RemoveSubscriber(websocket)
+        DropSessions(websocket)
+        del CONNECTIONS[id(websocket)]
+        OUTBOXES.pop(websocket, None)
+        sender.cancel()
+
+#################################################### Gateway ingestion
+
+# Sensor gateways send their readings to INGEST_PORT instead of the phone-facing port. A
+# frame is a batch of readings: binary frames are little-endian uint32s of
+# (space_id << 2) | status, and text frames are a JSON list of [space_id, status] pairs.
+# Nothing is sent back.
+#
+# A reading only becomes pending if it differs from the spot's status, and a pending
+# reading is applied once it has held for INGEST_DEBOUNCE seconds. Repeats of the pending
+# reading are absorbed, and a spot flapping back to its status before then is dropped, so
+# a car pulling in and out (or a noisy sensor) costs nothing downstream. IngestLoop() feeds
+# the readings that have settled to the state engine as one batch.
+
+INGEST_PENDING = {}                 # space_id -> (status, time.monotonic() it was first read), oldest first
+INGEST_STATS = {"frames": 0, "readings": 0, "invalid": 0, "flaps": 0, "applied": 0}
+
+def DecodeIngestFrame(frame):
+    # Returns the frame's readings as (space_id, status) pairs, or None if it is malformed
+    if isinstance(frame, bytes):
+        if len(frame) % 4 or len(frame) // 4 > INGEST_MAX_FRAME:
+            return None
+        words = array('I', frame)
+        if sys.byteorder != "little":
+            words.byteswap()
+        return [(word >> 2, word & 3) for word in words]
+
+    try:
+        readings = json.loads(frame)
+    except ValueError:
+        return None
+    if not isinstance(readings, list) or len(readings) > INGEST_MAX_FRAME:
+        return None
+    if not all(isinstance(reading, list) and len(reading) == 2 and
+               all(type(value) is int for value in reading) for reading in readings):
+        return None # Also rejects 1.0 and true, which would otherwise pass as status 1
+    return [tuple(reading) for reading in readings]
+
+def IngestReadings(readings):
+    now = time.monotonic()
+
+    for id, status in readings:
+        current = GetSpotStatus(id)
+        if current is None or status not in (0, 1): # Sensors only see free or occupied
+            INGEST_STATS["invalid"] += 1
+            continue
+
+        pending = INGEST_PENDING.get(id)
+        if pending is not None:
+            if pending[0] == status: # Same reading again; keep waiting
+                continue
+
+            del INGEST_PENDING[id]
+            if status == current: # Changed back before it settled
+                INGEST_STATS["flaps"] += 1
+                continue
+        elif status == current:
+            continue
+
+        INGEST_PENDING[id] = (status, now) # (Re)inserted last, keeping the dict oldest first
+
+    INGEST_STATS["readings"] += len(readings)
+
+async def IngestLoop():
+    while True:
+        await asyncio.sleep(INGEST_BATCH_INTERVAL)
+
+        settled = time.monotonic() - INGEST_DEBOUNCE
+        batch = []
+        for id, (status, since) in INGEST_PENDING.items():
+            if since > settled:
+                break
+            batch.append([id, status])
+
+        if not batch:
+            continue
+
+        for id, _ in batch:
+            del INGEST_PENDING[id]
+
+        startTime = time.perf_counter()
+        try:
+            results, updated, lotCount = await Publish({"type": "spots", "spots": batch})
+            INGEST_STATS["applied"] += len(updated)
+            RecordOp("IngestBatch", (time.perf_counter() - startTime) * 1000, False)
+        except Exception as e:
+            RecordOp("IngestBatch", (time.perf_counter() - startTime) * 1000, True)
+            print(f"[INGEST] Unexpected error applying {len(batch)} readings: {e}")
+
+async def HandleIngest(websocket):
+    global GATEWAY_CONNECTIONS
+    if GATEWAY_CONNECTIONS >= MAX_GATEWAY_CONNECTIONS:
+        print(f"[INGEST] At {MAX_GATEWAY_CONNECTIONS} gateways, turning {websocket.remote_address} away.")
+        CONNECTION_STATS["rejected"] += 1
+        await websocket.close(1013, "server_full")
+        return
+
+    GATEWAY_CONNECTIONS += 1
+    try:
+        async for frame in websocket:
+            readings = DecodeIngestFrame(frame)
+            INGEST_STATS["frames"] += 1
+
+            if readings is None:
+                print(f"[INGEST] Dropping malformed frame from {websocket.remote_address}.")
+                INGEST_STATS["invalid"] += 1
+                continue
+
+            IngestReadings(readings)
+    except websockets.exceptions.ConnectionClosedError:
+        print("[INGEST] Gateway connection closed without a close frame.")
+    finally:
+        GATEWAY_CONNECTIONS -= 1
 
 #################################################### Database initialization (for resetting the server-side information)
 
+# Spots are stored one of two ways (STORAGE_MODE):
+#   "spots": each spot is a {space_id, lot_id, status} document in SPOT_DOCS_COL, and the lot
+#            document only holds lot-level data (congestion_percent, avgCong, ...)
+#   "lots":  the original layout, with every spot in its lot document's "spaces" array
+# InitDB() moves existing data into the configured layout; migrate-spots.py does the same
+# while the server is down.
+
+INDEXES = [                         # (collection, keys, unique) created at startup
+    (USERS_COL, [("name", pymongo.ASCENDING)], True),
+    (SPOTS_COL, [("lot_id", pymongo.ASCENDING)], True),
+    (SPOT_DOCS_COL, [("space_id", pymongo.ASCENDING)], True),
+    (SPOT_DOCS_COL, [("lot_id", pymongo.ASCENDING)], False),
+    (RESV_COL, [("space_id", pymongo.ASCENDING)], True),
+    (HIST_COL, [("lot_id", pymongo.ASCENDING), ("date", pymongo.ASCENDING)], True)
+]
+
+def NewLotDoc(lotId, spaceIds):
+    lot = {
+        "lot_id": lotId,
+        "congestion_percent": 0,
+        "avgCong": {day: [-1 for i in range(0, HIST_SLOTS)] for day in WEEKDAYS}
+    }
+    if STORAGE_MODE == "lots":
+        lot["spaces"] = [{"space_id": id, "status": 0} for id in spaceIds]
+    return lot
+
+def NewSpotDoc(lotId, id, status=0):
+    return {"space_id": id, "lot_id": lotId, "status": status}
+
+async def EnsureIndexes():
+    for col, keys, unique in INDEXES:
+        try:
+            await RunDB(col.create_index, keys, unique=unique)
+        except pymongo.errors.OperationFailure as e: # e.g. existing duplicates block a unique index
+            print(f'[INITDB] Could not create index {keys} on {col.name}: {e}')
+
+async def MigrateSpotStorage(mode=STORAGE_MODE):
+    # Moves spots stored the other way into `mode`'s layout; returns how many lots moved.
+    # Each lot's spots are copied before they are removed from their old place, so an
+    # interrupted migration can simply be run again.
+    migrated = 0
+
+    if mode == "spots":
+        for lot in await FindAll(SPOTS_COL, {"spaces": {"$exists": True}}, {"_id": 0, "lot_id": 1, "spaces": 1}):
+            if lot["spaces"]:
+                await RunDB(SPOT_DOCS_COL.bulk_write, [
+                    pymongo.ReplaceOne({"space_id": spot["space_id"]}, NewSpotDoc(lot["lot_id"], spot["space_id"], spot["status"]), upsert=True)
+                    for spot in lot["spaces"]
+                ], ordered=False)
+            await RunDB(SPOTS_COL.update_one, {"lot_id": lot["lot_id"]}, {"$unset": {"spaces": ""}})
+            print(f'[MIGRATE] Moved {len(lot["spaces"])} spaces of lot {lot["lot_id"]} into spot documents.')
+            migrated += 1
+    else:
+        lotSpaces = {}
+        for spot in await FindAll(SPOT_DOCS_COL, {}, {"_id": 0}):
+            lotSpaces.setdefault(spot["lot_id"], []).append({"space_id": spot["space_id"], "status": spot["status"]})
+
+        for lotId, spaces in lotSpaces.items():
+            spaces.sort(key=lambda spot: spot["space_id"])
+            await RunDB(SPOTS_COL.update_one, {"lot_id": lotId}, {"$set": {"spaces": spaces}})
+            await RunDB(SPOT_DOCS_COL.delete_many, {"lot_id": lotId})
+            print(f'[MIGRATE] Moved {len(spaces)} spot documents of lot {lotId} into its spaces array.')
+            migrated += 1
+
+    return migrated
+
 async def InitDB():
-    ### TODO: Make sure to change later to implement as many spots and lots as needed
+    # Creates a document for every registered lot that doesn't have one yet, and adds any
+    # spaces the layout gained since the lot was created
 
     print('[INITDB] Running DB Precheck...')
-    
-    if (SPOTS_COL.count_documents({}) > 0):
-        print('[INITDB] DB exists, doing nothing.')
+    await EnsureIndexes()
+    await MigrateSpotStorage()
+
+    lotIds = {lot["lot_id"] for lot in await FindAll(SPOTS_COL, {}, {"_id": 0, "lot_id": 1})}
+    existing = {lotId: set() for lotId in lotIds}
+
+    if STORAGE_MODE == "spots":
+        for spot in await FindAll(SPOT_DOCS_COL, {}, {"_id": 0, "lot_id": 1, "space_id": 1}):
+            existing.setdefault(spot["lot_id"], set()).add(spot["space_id"])
+    else:
+        for lot in await FindAll(SPOTS_COL, {}, {"_id": 0, "lot_id": 1, "spaces.space_id": 1}):
+            existing[lot["lot_id"]] = {spot["space_id"] for spot in lot.get("spaces", [])}
+
+    requests = []
+    spotRequests = []
+
+    for lotId, lot in LOT_REGISTRY.items():
+        if lotId not in lotIds:
+            print(f'[INITDB] Creating lot {lotId} with {len(lot["spaces"])} spaces.')
+            requests.append(pymongo.InsertOne(NewLotDoc(lotId, lot["spaces"])))
+
+        newSpaces = [id for id in lot["spaces"] if id not in existing.get(lotId, ())]
+        if not newSpaces:
+            continue
+
+        if STORAGE_MODE == "spots":
+            spotRequests += [pymongo.InsertOne(NewSpotDoc(lotId, id)) for id in newSpaces]
+        elif lotId in lotIds:
+            requests.append(pymongo.UpdateOne(
+                {"lot_id": lotId},
+                {"$push": {"spaces": {"$each": [{"space_id": id, "status": 0} for id in newSpaces]}}}
+            ))
+
+        if lotId in lotIds:
+            print(f'[INITDB] Adding {len(newSpaces)} new spaces to lot {lotId}.')
+
+    if not requests and not spotRequests:
+        print('[INITDB] DB is up to date, doing nothing.')
         return
-    
-    print('[INITDB] No DB found, reinitializing!')
-    lots = [
-        {
-            "spaces": [{"space_id": j + 1, "status": 0 } for j in range(1251)],
-            "lot_id": "P6",
-            "congestion_percent": 0,
-            "histData" : {
-                "weekNumber" : 0,
-                "monday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "tuesday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "wednesday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "thursday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "friday" :[
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ]
-            },
-            "avgCong" : {
-                "monday" :      [-1 for i in range(0,32)],
-                "tuesday" :     [-1 for i in range(0,32)],
-                "wednesday" :   [-1 for i in range(0,32)],
-                "thursday" :    [-1 for i in range(0,32)],
-                "friday" :      [-1 for i in range(0,32)]
-            }
-        },
-        {
-            "spaces": [{"space_id": j + 1, "status": 0 } for j in range(1252,1873)],
-            "lot_id": "P5",
-            "congestion_percent": 0,
-            "histData" : {
-                "monday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "tuesday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "wednesday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "thursday" : [
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ],
-                "friday" :[
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)],
-                    [-1 for i in range(0,32)]
-                ]
-            },
-            "avgCong" : {
-                "monday" :      [-1 for i in range(0,32)],
-                "tuesday" :     [-1 for i in range(0,32)],
-                "wednesday" :   [-1 for i in range(0,32)],
-                "thursday" :    [-1 for i in range(0,32)],
-                "friday" :      [-1 for i in range(0,32)]
-            }
-        }
-    ]
-    
-    SPOTS_COL.insert_many(lots) # Insert array of lots
+
+    if requests:
+        await RunDB(SPOTS_COL.bulk_write, requests, ordered=False)
+    if spotRequests:
+        await RunDB(SPOT_DOCS_COL.bulk_write, spotRequests, ordered=False)
 
 #################################################### Server startup
 
+def MetricsPorts():
+    # Metrics port of each worker (just METRICS_PORT for a single process)
+    return [METRICS_PORT] if WORKERS == 1 else [WORKER_METRICS_PORT + workerId for workerId in range(WORKERS)]
+
+def CheckPorts():
+    ports = [PORT, INGEST_PORT] + MetricsPorts()
+    clashes = sorted({port for port in ports if ports.count(port) > 1})
+    if clashes:
+        raise SystemExit(f'[STARTUP] Port(s) {clashes} configured more than once; check SPOTME_PORT, SPOTME_INGEST_PORT and the metrics ports.')
+
 async def Start():
-    print('[STARTUP] Starting server...')
-    await InitDB()
+    CheckPorts()
+    if WORKERS > 1 and not IS_WORKER:
+        await Supervise()
+        return
+
+    print(f'[STARTUP] Starting server (worker {WORKER_ID} of {WORKERS})...' if IS_WORKER else '[STARTUP] Starting server...')
+    StartAuthPool()
+    LoadLotRegistry()
+    if not IS_WORKER: # The supervisor has prepared the DB
+        await InitDB()
+    await LoadSpotState()
+    await LoadReservations()
+    await LoadHistory()
+
+    connect = BROKERS[BROKER][0]
+    if connect is not None:
+        await connect()
+
     asyncio.create_task(UpdCongHistLoop())
-    async with websockets.serve(HandleMsg, '0.0.0.0', PORT) as server:
-        print(f"[STARTUP] Server listening on port {PORT}.")
-        await server.serve_forever()
+    asyncio.create_task(ForecastLoop())
+    asyncio.create_task(IngestLoop())
+    if IS_LEADER:
+        asyncio.create_task(FlushSpotsLoop())
+        asyncio.create_task(ReservationLoop())
+
+    metricsPort = MetricsPorts()[WORKER_ID]
+    metricsServer = await asyncio.start_server(HandleMetricsRequest, '0.0.0.0', metricsPort)
+    print(f"[STARTUP] Metrics available on port {metricsPort}.")
+    try:
+        async with websockets.serve(HandleIngest, '0.0.0.0', INGEST_PORT, max_size=16 * INGEST_MAX_FRAME, reuse_port=IS_WORKER):
+            print(f"[STARTUP] Gateway ingestion listening on port {INGEST_PORT}.")
+
+            async with websockets.serve(HandleMsg, '0.0.0.0', PORT, reuse_port=IS_WORKER) as server:
+                print(f"[STARTUP] Server listening on port {PORT}.")
+                serving = [asyncio.create_task(server.serve_forever())]
+                if BROKER_TASK is not None: # Without the broker this replica would fall behind
+                    serving.append(BROKER_TASK)
+                await asyncio.wait(serving, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        print('[SHUTDOWN] Flushing pending spot changes...')
+        await FlushSpots()
+        AUTH_EXECUTOR.shutdown()
+        metricsServer.close()
 
 if __name__ == "__main__":
     print("[STARTING]")
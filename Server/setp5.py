@@ -22,7 +22,9 @@ async def Start():
     async with websockets.connect(ADDR) as websocket:
 
         userInput = input("Input 'red','yellow', or 'green': ")
-        print("Batch updating P5... (takes a sec, dw)")
+        print("Batch updating P5...")
+
+        spots = []
 
         for i in range(1252,1873):
 
@@ -35,16 +37,16 @@ async def Start():
             else:
                 status = 0
 
-            updSpotInfo = {
-                "op": "UpdateSpot",
-                "id": i,
-                "status": status
-            }
-            
-            msg = json.dumps(updSpotInfo)
-            await Send(websocket, msg)
+            spots.append([i, status])
+
+        updSpotsInfo = {
+            "op": "UpdateSpots",
+            "spots": spots
+        }
 
-            await asyncio.sleep(0.001)
+        msg = json.dumps(updSpotsInfo)
+        response = json.loads(await Send(websocket, msg))
+        print(f"[RECEIVED] {response['status']}: {response['results'].count('spot_updated')} spots updated")
 
     print("Done.")
 
@@ -8,11 +8,29 @@ import {createStackNavigator} from '@react-navigation/stack';
 import * as Location from 'expo-location';
 import * as FileSystem from 'expo-file-system';
 import * as Notifications from "expo-notifications";
-import parkingData from './assets/parking_lot_data.json';
+import parkingColumns from './assets/parking_lot_columns.json';
 import Histogram from './components/histogram.js'
 
 const Stack = createStackNavigator();
 
+// Expands the columnar layout from Server/generate-spots.py into one object per spot.
+// Corners are stored as offsets from the layout's origin, four per spot.
+const expandParkingColumns = (columns) => {
+  const [originLat, originLon] = columns.origin;
+  return columns.id.map((id, index) => {
+    const corners = [0, 2, 4, 6].map((offset) => ({
+      latitude: originLat + columns.corners[index * 8 + offset],
+      longitude: originLon + columns.corners[index * 8 + offset + 1],
+    }));
+    return {
+      parkingLot: columns.lots[columns.lot[index]],
+      block: columns.block[index],
+      id: id,
+      coordinates: [...corners, corners[0]],
+    };
+  });
+};
+
 export default function App () {
   // Refs (for tracking objects between components)
   const mapRef = useRef(null);
@@ -28,8 +46,7 @@ export default function App () {
 
   //Pull parking spot data from assets
   useEffect(() =>{
-    //console.log(parkingData)
-    setParkingSpots(parkingData);
+    setParkingSpots(expandParkingColumns(parkingColumns));
   }, []);
 
   const getInitialDay = () => {